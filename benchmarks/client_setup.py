@@ -0,0 +1,104 @@
+'''
+Setup cost of many CIFAR clients
+
+    python -m benchmarks.client_setup --data_dir data/cifar10 --client_number 10000
+
+Reports the time load_partition_data takes, the size of what every pool
+worker receives for the per-client loaders, and the cost of building the
+loader of a client the first time it is trained. It then runs one round
+over the sampled clients: a local epoch of ResNet-56 each, on the CPU, and
+the server's sample-weighted aggregation of their models.
+'''
+import argparse
+import resource
+import time
+import numpy as np
+import torch
+import torch.multiprocessing # registers the shared-memory reductions used below
+from multiprocessing.reduction import ForkingPickler
+from data_preprocessing import data_loader as dl
+from methods.base import num_train_samples, trained_clients
+from models.resnet import resnet56
+
+def add_args(parser):
+    parser.add_argument('--data_dir', type=str, default='data/cifar10', metavar='N',
+                        help='CIFAR-10/100 data directory')
+    parser.add_argument('--client_number', type=int, default=10000, metavar='NN',
+                        help='number of clients')
+    parser.add_argument('--partition_method', type=str, default='hetero', metavar='N',
+                        help='how to partition the dataset: homo, hetero or longtail')
+    parser.add_argument('--partition_alpha', type=float, default=0.5, metavar='PA',
+                        help='alpha value for Dirichlet distribution partitioning of data')
+    parser.add_argument('--partition_seed', type=int, default=1, metavar='S',
+                        help='seed of the partition; the partition is cached per seed')
+    parser.add_argument('--batch_size', type=int, default=8, metavar='N',
+                        help='local batch size')
+    parser.add_argument('--sample_clients', type=int, default=20, metavar='NN',
+                        help='number of clients whose loader is built and read once, and that train in the round')
+    parser.add_argument('--lr', type=float, default=0.01, metavar='LR',
+                        help='learning rate of the local epoch')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = add_args(argparse.ArgumentParser(description='client-setup-benchmark'))
+
+    start = time.time()
+    _, _, _, _, data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num, *_ = dl.load_partition_data(
+        args.data_dir, args.partition_method, args.partition_alpha, args.client_number, args.batch_size,
+        seed=args.partition_seed)
+    setup = time.time() - start
+
+    # what a pool worker gets for the client loaders, shared tensors as handles
+    payload = len(ForkingPickler.dumps({'train_data': train_data_local_dict, 'test_data': test_data_local_dict}))
+
+    rng = np.random.RandomState(0)
+    sampled = rng.choice(args.client_number, min(args.sample_clients, args.client_number), replace=False).tolist()
+    build, first_batch = [], []
+    for client_idx in sampled:
+        start = time.time()
+        loader = train_data_local_dict[client_idx]
+        test_data_local_dict[client_idx]
+        build.append(time.time() - start)
+        if len(loader) > 0:
+            start = time.time()
+            next(iter(loader))
+            first_batch.append(time.time() - start)
+
+    # one round: a local epoch per client from the same global model, then
+    # the aggregation of Base_Server.operations
+    torch.manual_seed(0)
+    model = resnet56(int(class_num))
+    criterion = torch.nn.CrossEntropyLoss()
+    global_sd = {k: v.clone() for k, v in model.state_dict().items()}
+    results, train_time = [], []
+    start_round = time.time()
+    for client_idx in sampled:
+        start = time.time()
+        loader = train_data_local_dict[client_idx]
+        model.load_state_dict(global_sd)
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, nesterov=True)
+        for images, labels in loader:
+            optimizer.zero_grad()
+            criterion(model(images), labels.type(torch.LongTensor)).backward()
+            optimizer.step()
+        results.append({'weights': {k: v.clone() for k, v in model.state_dict().items()},
+                        'num_samples': num_train_samples(loader, args.batch_size), 'client_index': client_idx})
+        train_time.append(time.time() - start)
+    trained = trained_clients(results)
+    total = sum(c['num_samples'] for c in trained)
+    model.load_state_dict({key: sum(c['weights'][key]*(c['num_samples']/total) for c in trained) for key in global_sd})
+    round_time = time.time() - start_round
+    under_batch = sum(1 for c in results if c['num_samples'] < args.batch_size)
+
+    print('clients                 : {}'.format(args.client_number))
+    print('setup                   : {:.2f}s'.format(setup))
+    print('worker payload          : {:.1f}KB'.format(payload / 1024))
+    print('loader build per client : {:.2f}ms (mean of {})'.format(1000 * np.mean(build), len(build)))
+    if first_batch:
+        print('first batch per client  : {:.2f}ms (mean of {})'.format(1000 * np.mean(first_batch), len(first_batch)))
+    print('round                   : {:.2f}s for {} clients ({} under a batch, {} aggregated)'.format(
+        round_time, len(results), under_batch, len(trained)))
+    print('local epoch per client  : {:.2f}ms (mean)'.format(1000 * np.mean(train_time)))
+    print('loaders built           : {}'.format(len(train_data_local_dict.loaders)))
+    print('peak rss                : {:.0f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
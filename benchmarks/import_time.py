@@ -0,0 +1,111 @@
+'''
+Import time of the worker entry path
+
+    python -m benchmarks.import_time [--modules main methods.fedbb] [--budget 0.5]
+
+A spawned pool worker re-imports main.py (and the module of the client
+class it unpickles) before it can train. This imports them in a fresh
+interpreter under `python -X importtime`, reports the heaviest imports and
+who pulls them in, and fails (exit status 1) if the time spent outside
+torch and torchvision exceeds --budget seconds or if one of the --banned
+modules, only needed by tools or optional code paths, is imported.
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# imported by every worker whatever the project does; reported but not budgeted
+BASELINE = ('torch', 'torchvision')
+PROJECT = ('main', 'methods', 'models', 'data_preprocessing', 'benchmarks')
+
+def add_args(parser):
+    parser.add_argument('--modules', type=str, nargs='+', default=['main'],
+                        help='modules a worker imports')
+    parser.add_argument('--budget', type=float, default=0.5, metavar='S',
+                        help='seconds allowed for the imports outside torch and torchvision')
+    parser.add_argument('--banned', type=str, nargs='*',
+                        default=['cv2', 'matplotlib', 'imageio', 'sklearn', 'pandas'],
+                        help='top-level packages the entry path must not import')
+    parser.add_argument('--top', type=int, default=15, metavar='N',
+                        help='number of heaviest imports listed')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='runs; the fastest one is reported')
+    return parser.parse_args()
+
+def import_tree(modules):
+    """
+    Run `python -X importtime -c "import <modules>"` from the repository root.
+
+    Returns:
+        [(module, depth, self seconds, cumulative seconds, parent)] in the
+        order -X importtime prints them (children before their parent)
+    """
+    code = 'import ' + ', '.join(modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(code, proc.stderr[-2000:]))
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append([name.strip(), depth, int(self_us) / 1e6, int(cumulative_us) / 1e6, None])
+    # a module's parent is the next entry printed at a smaller depth
+    pending = {}
+    for row in rows:
+        for child in pending.pop(row[1] + 1, []):
+            child[4] = row[0]
+        pending.setdefault(row[1], []).append(row)
+    return [tuple(row) for row in rows]
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='import-time-benchmark'))
+
+    runs = [import_tree(args.modules) for _ in range(args.repeat)]
+    # only the imports under the entry modules count, not interpreter startup
+    total = lambda tree: sum(cumulative for name, depth, _, cumulative, _ in tree if depth == 0 and name in args.modules)
+    tree = min(runs, key=total)
+    elapsed = total(tree)
+    parents = {name: parent for name, _, _, _, parent in tree}
+    under, inside, baseline = set(), set(), 0.0
+    for name, _, _, cumulative, parent in reversed(tree): # parents first
+        if name in args.modules or parent in under:
+            under.add(name)
+        if parent in inside:
+            inside.add(name)
+        elif name in BASELINE and name in under:
+            inside.add(name)
+            baseline += cumulative
+    rest = elapsed - baseline
+
+    def importer(name):
+        # the first module outside the package of `name` on its import chain
+        package = name.split('.')[0]
+        while parents.get(name) is not None and parents[name].split('.')[0] == package:
+            name = parents[name]
+        return parents.get(name) or '-'
+
+    print('import {}: {:.2f}s, of which {} {:.2f}s and the rest {:.2f}s (budget {:.2f}s)'.format(
+        ', '.join(args.modules), elapsed, '/'.join(BASELINE), baseline, rest, args.budget))
+    print('heaviest packages outside {}:'.format('/'.join(BASELINE)))
+    heavy = {}
+    for name, _, _, cumulative, _ in tree:
+        package = name.split('.')[0]
+        if name in under and name not in inside and package not in PROJECT and importer(name).split('.')[0] in PROJECT:
+            heavy[package] = max(heavy.get(package, (0.0, None)), (cumulative, importer(name)))
+    for package, (cumulative, by) in sorted(heavy.items(), key=lambda item: -item[1][0])[:args.top]:
+        print('  {:8.3f}s  {:<24} imported by {}'.format(cumulative, package, by))
+
+    failed = False
+    for name in args.banned:
+        if name in parents and name in under:
+            print('{} is imported (by {})'.format(name, importer(name)))
+            failed = True
+    if rest > args.budget:
+        print('over budget by {:.2f}s'.format(rest - args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,113 @@
+'''
+Time of a FedAlign local training step for the ways a sub-width weight can
+reach the backend
+
+    python -m benchmarks.subnet_step [--width 0.25] [--batch_size 32] [--steps 20]
+
+A step of methods.fedalign.Client.train runs the full network and then the
+last stage at --width, once each before optimizer.step(). Every variant is
+timed on the same model, data and seed, interleaved so drift in the machine
+affects all of them alike:
+
+    strided    : the weight[:out, :in] view, as before contiguous slices
+    contiguous : USModule.sliced_weight, a contiguous copy under autograd
+    packed     : a per-width packed copy of the weight, rebuilt when an
+                 optimizer step changes the weight, whose gradient an
+                 autograd Function scatters back into the full weight
+'''
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from models import slimmable_ops
+from models.resnet_fedalign import resnet18, resnet56
+
+def add_args(parser):
+    parser.add_argument('--model', type=str, default='resnet56', metavar='N',
+                        help='resnet56 (CIFAR) or resnet18 (X-ray)')
+    parser.add_argument('--width', type=float, default=0.25, metavar='W',
+                        help='width of the subnet')
+    parser.add_argument('--batch_size', type=int, default=32, metavar='N',
+                        help='local batch size')
+    parser.add_argument('--steps', type=int, default=20, metavar='N',
+                        help='timed steps per variant')
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='torch threads')
+    return parser.parse_args()
+
+def strided_weight(self, out_channels, in_channels):
+    return self.weight[:out_channels, :in_channels]
+
+class ScatterGrad(torch.autograd.Function):
+    # forward returns the packed copy; backward puts its gradient in the full weight's corner
+    @staticmethod
+    def forward(ctx, weight, packed):
+        ctx.shape = weight.shape
+        return packed
+
+    @staticmethod
+    def backward(ctx, grad):
+        full = grad.new_zeros(ctx.shape)
+        full[:grad.size(0), :grad.size(1)] = grad
+        return full, None
+
+def packed_weight(self, out_channels, in_channels):
+    weight = self.weight
+    if out_channels == weight.size(0) and in_channels == weight.size(1):
+        return weight
+    key = ('packed', out_channels, in_channels)
+    cached = self.weight_cache.get(key)
+    if cached is None or cached[0] != weight._version:
+        cached = (weight._version, weight.detach()[:out_channels, :in_channels].contiguous())
+        self.weight_cache[key] = cached
+    return ScatterGrad.apply(weight, cached[1])
+
+VARIANTS = {'strided': strided_weight,
+            'contiguous': slimmable_ops.USModule.sliced_weight,
+            'packed': packed_weight}
+
+def train_step(model, optimizer, images, labels, width):
+    # the shape of fedalign.Client.train's step, with a stand-in for the Lipschitz loss
+    optimizer.zero_grad()
+    model.set_width(1.0)
+    t_feats, t_out = model.extract_feature(images)
+    F.cross_entropy(t_out, labels).backward()
+    model.set_width(width)
+    s_feats = model.reuse_feature(t_feats[-2].detach())
+    s_feats[-1].pow(2).mean().backward()
+    optimizer.step()
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='subnet-step-benchmark'))
+    torch.set_num_threads(args.threads)
+    size = 32 if args.model == 'resnet56' else 224
+
+    models = {}
+    for name in VARIANTS:
+        torch.manual_seed(0)
+        model = resnet56(10) if args.model == 'resnet56' else resnet18(14)
+        model.precompute_widths([args.width, 1.0])
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9, nesterov=True)
+        models[name] = (model, optimizer)
+    images = torch.randn(args.batch_size, 3, size, size)
+    labels = torch.randint(0, 10, (args.batch_size,))
+
+    times = {name: [] for name in VARIANTS}
+    for step in range(args.steps + 1):
+        for name, sliced_weight in VARIANTS.items():
+            slimmable_ops.USModule.sliced_weight = sliced_weight
+            start = time.perf_counter()
+            train_step(*models[name], images, labels, args.width)
+            if step > 0: # the first step warms up the allocator
+                times[name].append(time.perf_counter() - start)
+    slimmable_ops.USModule.sliced_weight = VARIANTS['contiguous']
+
+    reference = [p.detach() for p in models['strided'][0].parameters()]
+    print('{} width {} batch {}, median of {} steps:'.format(args.model, args.width, args.batch_size, args.steps))
+    for name in VARIANTS:
+        same = all(torch.allclose(p, q, atol=1e-5) for p, q in zip(models[name][0].parameters(), reference))
+        print('  {:<10} : {:7.1f}ms (p10 {:.1f}ms, p90 {:.1f}ms){}'.format(
+            name, 1000 * np.median(times[name]), 1000 * np.percentile(times[name], 10),
+            1000 * np.percentile(times[name], 90), '' if same else ', weights differ from strided'))
@@ -0,0 +1,194 @@
+'''
+Node-wide decode/augment service shared by all client threads
+'''
+import logging
+import random
+import zlib
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+def batch_seed(key):
+    # augmentation of a batch only depends on its (client_idx, epoch, batch)
+    # key, not on the worker that happens to build it
+    return zlib.crc32('{}-{}-{}'.format(*key).encode())
+
+def first_sample(source, num_clients):
+    # one collated sample of the first non-empty client, to size the slots
+    for client_idx in range(num_clients):
+        loader = source(client_idx)
+        if len(loader.dataset) > 0:
+            return loader.collate_fn([loader.dataset[0]]), loader.batch_size
+    raise ValueError('every client is empty')
+
+def decode_worker(source, tasks, lanes, max_datasets=64):
+    """
+    Worker process of a BatchService: builds the batches it is asked for
+    and writes them into the requesting lane's slot.
+    """
+    torch.set_num_threads(1)
+    datasets = OrderedDict() # client_idx -> (dataset, collate_fn), least recently used first
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        lane_id, slot, key, positions = task
+        lane = lanes[lane_id]
+        try:
+            client_idx = key[0]
+            if client_idx not in datasets:
+                loader = source(client_idx)
+                datasets[client_idx] = (loader.dataset, loader.collate_fn)
+                if len(datasets) > max_datasets:
+                    datasets.popitem(last=False)
+            datasets.move_to_end(client_idx)
+            dataset, collate_fn = datasets[client_idx]
+
+            seed = batch_seed(key)
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            random.seed(seed)
+            images, targets = collate_fn([dataset[i] for i in positions])
+            lane.images[slot, :len(positions)].copy_(images)
+            lane.targets[slot, :len(positions)].copy_(targets)
+            lane.results.put((slot, key, len(positions)))
+        except Exception as e:
+            logging.exception('batch service failed on %s' % str(key))
+            lane.results.put((slot, key, repr(e)))
+
+class BatchLane(object):
+    """
+    The share of a BatchService that belongs to one client thread: its
+    shared-memory slots and the queue its finished batches arrive on.
+    """
+    def __init__(self, index, tasks, results, images, targets):
+        self.index = index
+        self.tasks = tasks
+        self.results = results
+        self.images = images
+        self.targets = targets
+        self.loaders = {}
+
+    @property
+    def num_slots(self):
+        return self.images.shape[0]
+
+    def loader(self, client_idx, loader):
+        # a ServiceLoader standing in for the train DataLoader of client_idx
+        if client_idx not in self.loaders:
+            self.loaders[client_idx] = ServiceLoader(self, client_idx, loader)
+        return self.loaders[client_idx]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['loaders'] = {}
+        return state
+
+class ServiceLoader(object):
+    """
+    Iterates over the batches of a client's train DataLoader (same batch
+    size, sampler and drop_last) while the service builds them; up to
+    num_slots batches are in flight.
+    """
+    def __init__(self, lane, client_idx, loader):
+        self.lane = lane
+        self.client_idx = client_idx
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.drop_last = loader.drop_last
+        # RandomSampler, ShardShuffleSampler or SequentialSampler
+        self.sampler = loader.sampler
+        self.epoch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = np.fromiter(iter(self.sampler), dtype=np.int64, count=n)
+        batches = [order[b * self.batch_size:(b + 1) * self.batch_size] for b in range(len(self))]
+        epoch = self.epoch
+        self.epoch += 1
+
+        free = list(range(self.lane.num_slots))
+        done = {} # batch -> (slot, size)
+        submitted = received = 0
+        try:
+            for b in range(len(batches)):
+                while free and submitted < len(batches):
+                    self.lane.tasks.put((self.lane.index, free.pop(), (self.client_idx, epoch, submitted), batches[submitted]))
+                    submitted += 1
+                while b not in done:
+                    slot, key, size = self.lane.results.get()
+                    received += 1
+                    if isinstance(size, str):
+                        raise RuntimeError('batch service failed on {}: {}'.format(key, size))
+                    done[key[2]] = (slot, size)
+                slot, size = done.pop(b)
+                images = self.lane.images[slot, :size].clone()
+                targets = self.lane.targets[slot, :size].clone()
+                free.append(slot)
+                yield images, targets
+        finally:
+            # an abandoned epoch still has batches being written into the
+            # slots; wait for them before the slots are handed out again
+            while received < submitted:
+                self.lane.results.get()
+                received += 1
+
+class BatchService(object):
+    """
+    A pool of decode/augment processes shared by all client threads of the
+    node, instead of every thread decoding (or running DataLoader workers)
+    for its own clients. A thread asks for the batches of an epoch of a
+    client, keyed by (client_idx, epoch, batch); a worker builds a batch
+    from the client's dataset and collate_fn and writes it into one of the
+    thread's shared-memory slots, so batches are never pickled. Random
+    augmentations are seeded from the key.
+
+    Args:
+        source : picklable, client_idx -> train DataLoader of that client
+                 (e.g. the build of the train ClientRegistry); workers use its
+                 dataset and collate_fn
+        num_clients : clients are 0 .. num_clients - 1
+        num_workers : decode processes
+        lanes : number of client threads
+        slots : batches in flight per thread
+    """
+    def __init__(self, source, num_clients, num_workers=4, lanes=1, slots=4):
+        (images, targets), batch_size = first_sample(source, num_clients)
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.lanes = []
+        for i in range(lanes):
+            self.lanes.append(BatchLane(i, self.tasks, ctx.Queue(),
+                                        torch.empty((slots, batch_size) + images.shape[1:], dtype=images.dtype).share_memory_(),
+                                        torch.empty((slots, batch_size) + targets.shape[1:], dtype=targets.dtype).share_memory_()))
+        self.free_lanes = ctx.Queue()
+        for i in range(lanes):
+            self.free_lanes.put(i)
+        self.workers = [ctx.Process(target=decode_worker, args=(source, self.tasks, self.lanes), daemon=True)
+                        for _ in range(num_workers)]
+        for w in self.workers:
+            w.start()
+        logging.info('batch service: {} workers, {} lanes of {} x {} slots'.format(
+            num_workers, lanes, slots, tuple(self.lanes[0].images.shape[1:])))
+
+    def claim_lane(self):
+        # called once by every client thread
+        return self.lanes[self.free_lanes.get()]
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join()
+
+    def __getstate__(self):
+        # threads get the queues and slots, not the worker processes
+        state = self.__dict__.copy()
+        state['workers'] = []
+        return state
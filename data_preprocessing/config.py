@@ -1,5 +1,5 @@
 pkl_dir_path             = 'pickles'
-train_val_df_pkl_path    = 'train_val_df.pickle'
-test_df_pkl_path         = 'test_df.pickle'
-disease_classes_pkl_path = 'disease_classes.pickle'
-models_dir               = 'models'
\ No newline at end of file
+nih_index_path           = 'nih_index.npz'
+models_dir               = 'models'
+image_cache_dir          = 'image_cache'
+shards_dir               = 'shards'
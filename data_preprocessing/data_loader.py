@@ -2,159 +2,53 @@
 Federated Dataset Loading and Partitioning
 Code based on https://github.com/FedML-AI/FedML
 '''
-import glob, os, sys, pdb, time
-import pandas as pd
+import os, time
 import numpy as np
-import cv2
-import pickle
 from torch.utils.data import Dataset
-from tqdm import tqdm
 import torch
 import torchvision.transforms as transforms
-from imageio import imread
-from PIL import Image, ImageOps
-import torchvision.models as models 
-import torch.nn as nn
-from matplotlib import pyplot as plt
-import csv
-import pandas as pd
+from PIL import Image
 import PIL.Image as pilimg
-import random
 import logging
 
-import numpy as np
-from numpy.core.fromnumeric import mean
 import torch.utils.data as data
-import torchvision.transforms as transforms
 from data_preprocessing import config
-from data_preprocessing.datasets import CIFAR_truncated, ImageFolder_custom
+from data_preprocessing.metadata import NIH_CLASSES, CHEXPERT_TRAIN_CSV, CHEXPERT_TEST_CSV, NIHMetadata, ChexpertMetadata
+from data_preprocessing.datasets import CIFAR_truncated, ImageFolder_custom, load_cifar
+from data_preprocessing.image_cache import ImageCache, NormalizeBatch, reduce_on_decode
+from data_preprocessing.partition import XRAY_TRAIN_NUM, dataset_name, get_imbalance, imbalance_weights, load_partition, partition_path, record_net_data_stats
+from data_preprocessing.registry import ClientRegistry, LazyLoader
+from data_preprocessing.sample_cache import get_sample_cache
+from data_preprocessing.shards import has_shards, open_shards, shard_dir, shard_sampler
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def distribute_indices(length, alpha):
-
-    ratios = np.round(np.random.dirichlet(np.repeat(alpha, 5))*length).astype(int)
-    indices = list(range(length))
-    random.shuffle(indices)
-
-    ### Client num should be greater than 
-    if sum(ratios) > length:
-        ratios[4] -= (sum(ratios) - length)
-    else:
-        ratios[4] += (length - sum(ratios))
-
-    indices0 = []
-    indices1 = []
-    indices2 = []
-    indices3 = []
-    indices4 = []
-
-    for i in range(0,ratios[0]):
-        indices0.append(indices[i])
-    for i in range(ratios[0],ratios[0] + ratios[1]):
-        indices1.append(indices[i])
-    for i in range(ratios[0] + ratios[1],ratios[0] + ratios[1] + ratios[2]):
-        indices2.append(indices[i])
-    for i in range(ratios[0] + ratios[1] + ratios[2],ratios[0] + ratios[1] + ratios[2] + ratios[3]):
-        indices3.append(indices[i])
-    for i in range(ratios[0] + ratios[1] + ratios[2] + ratios[3], length):
-        indices4.append(indices[i])
-
-    indices = [indices0,indices1,indices2,indices3,indices4]
-
-    return indices
-
-def check_version(cifar_version):
-    if cifar_version not in ['10', '100', '20']:
-        raise ValueError('cifar version must be one of 10, 20, 100.')
-
-def img_num(cifar_version):
-    check_version(cifar_version)
-    dt = {'10': 5000, '100': 500, '20': 2500}
-    return dt[cifar_version]
-
-def get_img_num_per_cls(cifar_version, imb_factor=0.1):
-    """
-    Get a list of image numbers for each class, given cifar version
-    Num of imgs follows emponential distribution
-    img max: 5000 / 500 * e^(-lambda * 0);
-    img min: 5000 / 500 * e^(-lambda * int(cifar_version - 1))
-    exp(-lambda * (int(cifar_version) - 1)) = img_max / img_min
-    args:
-      cifar_version: str, '10', '100', '20'
-      imb_factor: float, imbalance factor: img_min/img_max,
-        None if geting default cifar data number
-    output:
-      img_num_per_cls: a list of number of images per class
-    """
-    cls_num = int(cifar_version)
-    img_max = img_num(cifar_version)
-    if imb_factor is None:
-        return [img_max] * cls_num
-    img_num_per_cls = []
-    for cls_idx in range(cls_num):
-        num = img_max * (imb_factor**(cls_idx / (cls_num - 1.0)))
-        img_num_per_cls.append(int(num))
-    return img_num_per_cls
-
 class NIHTrainDataset(Dataset):
-    def __init__(self,c_num, data_dir, transform = None, indices=None):
+    def __init__(self,c_num, data_dir, transform = None, indices=None, metadata=None, cache=None, shards=None, sample_cache=None):
         
         self.data_dir = data_dir
         self.transform = transform
-        self.df = self.get_df()
-        self.make_pkl_dir(config.pkl_dir_path)
         self.the_chosen = indices
-        
-        self.disease_cnt = [0]*14
-        self.all_classes = ['Cardiomegaly','Emphysema','Effusion','Hernia','Infiltration','Mass','Nodule','Atelectasis','Pneumothorax','Pleural_Thickening','Pneumonia','Fibrosis','Edema','Consolidation', 'No Finding']
-        
-        if not os.path.exists(os.path.join(config.pkl_dir_path, config.train_val_df_pkl_path)):
-
-            self.train_val_df = self.get_train_val_df()
-            # pickle dump the train_val_df
-            with open(os.path.join(config.pkl_dir_path, config.train_val_df_pkl_path), 'wb') as handle:
-                pickle.dump(self.train_val_df, handle, protocol = pickle.HIGHEST_PROTOCOL)
-        else:
-            # pickle load the train_val_df
-            with open(os.path.join(config.pkl_dir_path, config.train_val_df_pkl_path), 'rb') as handle:
-                self.train_val_df = pickle.load(handle)
-        
-        self.new_df = self.train_val_df.iloc[self.the_chosen, :] # this is the sampled train_val data
-    
-        if not os.path.exists(os.path.join(config.pkl_dir_path, config.disease_classes_pkl_path)):
-            # pickle dump the classes list
-            with open(os.path.join(config.pkl_dir_path, config.disease_classes_pkl_path), 'wb') as handle:
-                pickle.dump(self.all_classes, handle, protocol = pickle.HIGHEST_PROTOCOL)
-                print('\n{}: dumped'.format(config.disease_classes_pkl_path))
-        else:
-            pass
-
-        for i in range(len(self.new_df)):
-            row = self.new_df.iloc[i, :]
-            labels = str.split(row['Finding Labels'], '|')
-            for lab in labels:  
-                lab_idx = self.all_classes.index(lab)
-                if lab_idx == 14: # No Finding
-                    continue
-                self.disease_cnt[lab_idx] += 1
-
-        self.total_ds_cnt = np.array(self.disease_cnt)
-        # Normalize the imbalance
-        self.imbalance = 0
-        difference_cnt = self.total_ds_cnt - self.total_ds_cnt.mean()
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = difference_cnt[i] * difference_cnt[i]        
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = difference_cnt[i] / difference_cnt.sum()
-        # Calculate the level of imbalnce
-        difference_cnt -= difference_cnt.mean()
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = (difference_cnt[i] * difference_cnt[i])
-    
-        self.imbalance = 1 / difference_cnt.sum()
+        # rows of the preprocessed train_val images, see ImageCache
+        self.cache = cache
+        # or of the packed train_val images, see ShardReader
+        self.shards = shards
+        self.shard_ids = shards.shard[indices] if shards is not None else None
+        self.sample_cache = sample_cache
+        self.all_classes = NIH_CLASSES
+
+        if metadata is None:
+            metadata = NIHMetadata(self.data_dir)
+        # this is the sampled train_val data; only these rows are kept so the
+        # shared metadata is not copied into every client dataset
+        self.paths = metadata.train_val_paths[self.the_chosen]
+        self.labels = np.ascontiguousarray(metadata.train_val_labels[self.the_chosen, :14]) # without No Finding
+
+        self.total_ds_cnt = self.labels.sum(axis=0, dtype=np.int64)
+        self.disease_cnt = self.total_ds_cnt.tolist()
+        self.imbalance = get_imbalance(self.total_ds_cnt)
 
     def get_ds_cnt(self, c_num):
 
@@ -165,64 +59,26 @@ class NIHTrainDataset(Dataset):
             
     def compute_class_freqs(self):
         # total number of patients (rows)
-        labels = self.train_val_df ## What is the shape of this???
+        labels = self.labels
         N = labels.shape[0]
         positive_frequencies = (labels.sum(axis = 0))/N
         negative_frequencies = 1.0 - positive_frequencies
     
         return positive_frequencies, negative_frequencies
 
-    def make_pkl_dir(self, pkl_dir_path):
-        if not os.path.exists(pkl_dir_path):
-            os.mkdir(pkl_dir_path)
-
-    def get_train_val_df(self):
-
-        # get the list of train_val data 
-        train_val_list = self.get_train_val_list()
-        print("train_va_list: ",len(train_val_list))
-
-        train_val_df = pd.DataFrame()
-        print('\nbuilding train_val_df...')
-        for i in tqdm(range(self.df.shape[0])):
-            filename  = os.path.basename(self.df.iloc[i,0])
-            if filename in train_val_list:
-                train_val_df = train_val_df.append(self.df.iloc[i:i+1, :])
-        return train_val_df
-
     def __getitem__(self, index):
 
-        self.all_classes = ['Cardiomegaly','Emphysema','Effusion','Hernia','Infiltration','Mass','Nodule','Atelectasis','Pneumothorax','Pleural_Thickening','Pneumonia','Fibrosis','Edema','Consolidation', 'No Finding']
-        row = self.new_df.iloc[index, :]
-        # img = cv2.imread(row['image_links'])
-        img = Image.open(row['image_links'])
-        labels = str.split(row['Finding Labels'], '|')
-        target = torch.zeros(len(self.all_classes))
-        new_target = torch.zeros(len(self.all_classes) - 1)
-        for lab in labels:
-            lab_idx = self.all_classes.index(lab)
-            target[lab_idx] = 1            
+        target = torch.from_numpy(self.labels[index]).float()
+        if self.cache is not None:
+            return self.cache[self.the_chosen[index]], target
+        open_image = lambda: self.shards.image(self.the_chosen[index]) if self.shards is not None else Image.open(self.paths[index])
+        if self.sample_cache is not None:
+            return self.sample_cache.load(self.paths[index], open_image, self.transform), target
+        img = open_image()
         if self.transform is not None:
             img = self.transform(img)
 
-        return img, target[:14]
-       
-    def get_df(self):
-        csv_path = os.path.join(self.data_dir, 'Data_Entry_2017.csv')
-        all_xray_df = pd.read_csv(csv_path)
-
-        df = pd.DataFrame()        
-        df['image_links'] = [x for x in glob.glob(os.path.join(self.data_dir, 'images*', '*', '*.png'))]
-
-        df['Image Index'] = df['image_links'].apply(lambda x : x[len(x)-16:len(x)])
-        merged_df = df.merge(all_xray_df, how = 'inner', on = ['Image Index'])
-        merged_df = merged_df[['image_links','Finding Labels']]
-        return merged_df
-    
-    def get_train_val_list(self):
-        f = open("data/NIH/train_val_list(original)", 'r')
-        train_val_list = str.split(f.read(), '\n')
-        return train_val_list
+        return img, target
 
     def __len__(self):
         return len(self.the_chosen)
@@ -235,134 +91,79 @@ class NIHTrainDataset(Dataset):
 
 class NIHTestDataset(Dataset):
 
-    def __init__(self, data_dir, transform = None):
+    def __init__(self, data_dir, transform = None, metadata=None, cache=None, shards=None, sample_cache=None):
         self.data_dir = data_dir
         self.transform = transform
-        # full dataframe including train_val and test set
-        self.df = self.get_df()
-        self.make_pkl_dir(config.pkl_dir_path)
-        self.disease_cnt = [0]*14
-        self.all_classes = ['Cardiomegaly','Emphysema','Effusion','Hernia','Infiltration','Mass','Nodule','Atelectasis','Pneumothorax','Pleural_Thickening','Pneumonia','Fibrosis','Edema','Consolidation', 'No Finding']
-
-        # loading the classes list
-        with open(os.path.join(config.pkl_dir_path, config.disease_classes_pkl_path), 'rb') as handle:
-            self.all_classes = pickle.load(handle) 
-        # get test_df
-        if not os.path.exists(os.path.join(config.pkl_dir_path, config.test_df_pkl_path)):
-            self.test_df = self.get_test_df()
-            with open(os.path.join(config.pkl_dir_path, config.test_df_pkl_path), 'wb') as handle:
-                pickle.dump(self.test_df, handle, protocol = pickle.HIGHEST_PROTOCOL)
-            print('\n{}: dumped'.format(config.test_df_pkl_path))
-        else:
-            # pickle load the test_df
-            with open(os.path.join(config.pkl_dir_path, config.test_df_pkl_path), 'rb') as handle:
-                self.test_df = pickle.load(handle)
-
-        for i in range(len(self.test_df)):
-            row = self.test_df.iloc[i, :]
-            labels = str.split(row['Finding Labels'], '|')
-            for lab in labels:  
-                lab_idx = self.all_classes.index(lab)
-                if lab_idx == 14: # No Finding
-                    continue
-                self.disease_cnt[lab_idx] += 1
+        self.cache = cache
+        self.shards = shards
+        self.sample_cache = sample_cache
+        self.all_classes = NIH_CLASSES
+
+        if metadata is None:
+            metadata = NIHMetadata(self.data_dir)
+        self.paths = metadata.test_paths
+        self.labels = np.ascontiguousarray(metadata.test_labels[:, :14]) # without No Finding
+
+        self.disease_cnt = self.labels.sum(axis=0, dtype=np.int64).tolist()
 
     def get_ds_cnt(self):
         return self.disease_cnt
 
     def __getitem__(self, index):
-        row = self.test_df.iloc[index, :]
-        # img = cv2.imread(row['image_links'])
-        img = Image.open(row['image_links'])
-        labels = str.split(row['Finding Labels'], '|')
-        target = torch.zeros(len(self.all_classes)) # 15
-        for lab in labels:
-            lab_idx = self.all_classes.index(lab)
-            target[lab_idx] = 1     
+        target = torch.from_numpy(self.labels[index]).float()
+        if self.cache is not None:
+            return self.cache[index], target
+        open_image = lambda: self.shards.image(index) if self.shards is not None else Image.open(self.paths[index])
+        if self.sample_cache is not None:
+            return self.sample_cache.load(self.paths[index], open_image, self.transform), target
+        img = open_image()
         if self.transform is not None:
             img = self.transform(img)
-        return img, target[:14]
-
-    def make_pkl_dir(self, pkl_dir_path):
-        if not os.path.exists(pkl_dir_path):
-            os.mkdir(pkl_dir_path)
-
-    def get_df(self):
-        csv_path = os.path.join(self.data_dir, 'Data_Entry_2017.csv')
-        all_xray_df = pd.read_csv(csv_path)
-        df = pd.DataFrame()        
-        df['image_links'] = [x for x in glob.glob(os.path.join(self.data_dir, 'images*', '*', '*.png'))]
-        df['Image Index'] = df['image_links'].apply(lambda x : x[len(x)-16:len(x)])
-        merged_df = df.merge(all_xray_df, how = 'inner', on = ['Image Index'])
-        merged_df = merged_df[['image_links','Finding Labels']]
-        return merged_df
-
-    def get_test_df(self):
-        # get the list of test data 
-        test_list = self.get_test_list()
-        test_df = pd.DataFrame()
-        for i in tqdm(range(self.df.shape[0])):
-            filename  = os.path.basename(self.df.iloc[i,0])
-            if filename in test_list:
-                test_df = test_df.append(self.df.iloc[i:i+1, :])
-        return test_df
-
-    def get_test_list(self):
-        f = open( os.path.join('data/NIH', 'test_list.txt'), 'r')
-        test_list = str.split(f.read(), '\n')
-        return test_list
+        return img, target
 
     def __len__(self):
-        return len(self.test_df)
+        return len(self.paths)
 
 class ChexpertTrainDataset(Dataset):
 
-    def __init__(self,c_num, transform = None, indices = None):
+    def __init__(self,c_num, transform = None, indices = None, metadata = None, cache = None, channels = 3, shards = None, sample_cache = None):
         
-        csv_path = "data/CheXpert-v1.0-small/selected_train.csv"
-        self.dir = "data/"
         self.transform = transform
-
-        self.all_data = pd.read_csv(csv_path)
-        self.selecte_data = self.all_data.iloc[indices, :]
+        # the grayscale image is broadcast (not copied) to `channels` channels
+        self.channels = channels
+        self.indices = indices
+        self.cache = cache
+        self.shards = shards
+        self.shard_ids = shards.shard[indices] if shards is not None else None
+        self.sample_cache = sample_cache
+
+        if metadata is None:
+            metadata = ChexpertMetadata(CHEXPERT_TRAIN_CSV)
+        self.paths = metadata.paths[indices]
+        self.labels = metadata.labels[indices]
         self.class_num = 10
         self.all_classes = ['Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Opacity', 'Lung Lesion', 'Edema', 'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Fracture']
         
         self.total_ds_cnt = self.get_total_cnt()
-        self.total_ds_cnt = np.array(self.total_ds_cnt)
-        # Normalize the imbalance
-        self.imbalance = 0
-        difference_cnt = self.total_ds_cnt - self.total_ds_cnt.mean()
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = difference_cnt[i] * difference_cnt[i]        
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = difference_cnt[i] / difference_cnt.sum()
-        # Calculate the level of imbalnce
-        difference_cnt -= difference_cnt.mean()
-        for i in range(len(difference_cnt)):
-            difference_cnt[i] = (difference_cnt[i] * difference_cnt[i])
-    
-        self.imbalance = 1 / difference_cnt.sum()
+        self.imbalance = get_imbalance(self.total_ds_cnt)
 
     def __getitem__(self, index):
 
-        row = self.selecte_data.iloc[index, :]
-        # img = cv2.imread(self.dir + row['Path'])
-        img = pilimg.open(self.dir + row['Path'])
-        label = torch.FloatTensor(row[2:])
-        gray_img = self.transform(img)
-        return torch.cat([gray_img,gray_img,gray_img], dim = 0), label
+        label = torch.from_numpy(self.labels[index]).float()
+        if self.cache is not None:
+            return self.cache[self.indices[index]], label
+        open_image = lambda: self.shards.image(self.indices[index]) if self.shards is not None else pilimg.open(self.paths[index])
+        if self.sample_cache is not None:
+            gray_img = self.sample_cache.load(self.paths[index], open_image, self.transform)
+        else:
+            gray_img = self.transform(open_image())
+        return gray_img.expand(self.channels, -1, -1), label
 
     def __len__(self):
-        return len(self.selecte_data)
+        return len(self.paths)
 
     def get_total_cnt(self):
-        total_ds_cnt = [0] * self.class_num
-        for i in range(len(self.selecte_data)):
-            row = self.selecte_data.iloc[i, 2:]
-            for j in range(len(row)):
-                total_ds_cnt[j] += int(row[j])
-        return total_ds_cnt
+        return self.labels.sum(axis=0, dtype=np.int64)
 
     def get_ds_cnt(self):
 
@@ -379,46 +180,39 @@ class ChexpertTrainDataset(Dataset):
 
 class ChexpertTestDataset(Dataset):
 
-    def __init__(self, transform = None):
+    def __init__(self, transform = None, metadata = None, cache = None, channels = 3, shards = None, sample_cache = None):
         
-        csv_path = "data/CheXpert-v1.0-small/selected_test.csv"
-        self.dir = "data/"
         self.transform = transform
-
-        self.all_data = pd.read_csv(csv_path)
-        self.selecte_data = self.all_data.iloc[:, :]
+        self.channels = channels
+        self.cache = cache
+        self.shards = shards
+        self.sample_cache = sample_cache
+
+        if metadata is None:
+            metadata = ChexpertMetadata(CHEXPERT_TEST_CSV)
+        self.paths = metadata.paths
+        self.labels = metadata.labels
         self.class_num = 10
 
     def __getitem__(self, index):
 
-        row = self.selecte_data.iloc[index, :]
-        img = pilimg.open(self.dir + row['Path'])
-        label = torch.FloatTensor(row[2:])
-        gray_img = self.transform(img)
+        label = torch.from_numpy(self.labels[index]).float()
+        if self.cache is not None:
+            return self.cache[index], label
+        open_image = lambda: self.shards.image(index) if self.shards is not None else pilimg.open(self.paths[index])
+        if self.sample_cache is not None:
+            gray_img = self.sample_cache.load(self.paths[index], open_image, self.transform)
+        else:
+            gray_img = self.transform(open_image())
 
-        return torch.cat([gray_img,gray_img,gray_img], dim = 0), label
+        return gray_img.expand(self.channels, -1, -1), label
 
     def get_ds_cnt(self):
-        total_ds_cnt = [0] * self.class_num
-        for i in range(len(self.selecte_data)):
-            row = self.selecte_data.iloc[i, 2:]
-            for j in range(len(row)):
-                total_ds_cnt[j] += int(row[j])
-        return total_ds_cnt
+        return self.labels.sum(axis=0, dtype=np.int64).tolist()
 
     def __len__(self):
-        return len(self.selecte_data)
-
-
-def record_net_data_stats(y_train, net_dataidx_map):
-    net_cls_counts = {}
+        return len(self.paths)
 
-    for net_i, dataidx in net_dataidx_map.items():
-        unq, unq_cnt = np.unique(y_train[dataidx], return_counts=True)
-        tmp = {unq[i]: unq_cnt[i] for i in range(len(unq))}
-        net_cls_counts[net_i] = tmp
-    logging.debug('Data statistics: %s' % str(net_cls_counts))
-    return net_cls_counts
 
 def _data_transforms_cifar(datadir):
     if "cifar100" in datadir:
@@ -443,6 +237,55 @@ def _data_transforms_cifar(datadir):
 
     return train_transform, valid_transform
 
+class CIFARBatchTransform(object):
+    """
+    collate_fn for CIFAR_truncated without a per-sample transform: works on
+    the stacked (B, 32, 32, 3) uint8 batch instead of going through PIL for
+    every image. For training it applies the augmentation of
+    _data_transforms_cifar (zero-padded random crop, random horizontal
+    flip) with per-sample random offsets, as a single gather; then the
+    whole batch is scaled and normalized.
+    """
+    def __init__(self, mean, std, train=True, size=32, padding=4):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.train = train
+        self.size = size
+        self.padding = padding
+
+    def random_crop_flip(self, images):
+        # images : (B, H, W, C) uint8
+        B = images.shape[0]
+        p = self.padding
+        padded = torch.nn.functional.pad(images, (0, 0, p, p, p, p))
+        top = torch.randint(0, padded.shape[1] - self.size + 1, (B, 1))
+        left = torch.randint(0, padded.shape[2] - self.size + 1, (B, 1))
+        rows = top + torch.arange(self.size)
+        cols = left + torch.arange(self.size)
+        # a horizontal flip is the same crop read right to left
+        flip = torch.rand(B, 1) < 0.5
+        cols = torch.where(flip, cols.flip(1), cols)
+        return padded[torch.arange(B)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+    def __call__(self, batch):
+        images, targets = zip(*batch)
+        images = torch.from_numpy(np.stack(images))
+        if self.train:
+            images = self.random_crop_flip(images)
+        images = images.permute(0, 3, 1, 2).contiguous().float().div_(255)
+        images = images.sub_(self.mean).div_(self.std)
+        return images, torch.from_numpy(np.array(targets))
+
+def _batch_transforms_cifar(datadir):
+    if "cifar100" in datadir:
+        CIFAR_MEAN = [0.5071, 0.4865, 0.4409]
+        CIFAR_STD = [0.2673, 0.2564, 0.2762]
+    else:
+        CIFAR_MEAN = [0.49139968, 0.48215827, 0.44653124]
+        CIFAR_STD = [0.24703233, 0.24348505, 0.26158768]
+
+    return CIFARBatchTransform(CIFAR_MEAN, CIFAR_STD, train=True), CIFARBatchTransform(CIFAR_MEAN, CIFAR_STD, train=False)
+
 def _data_transforms_imagenet(datadir):
     mean = [0.485, 0.456, 0.406]
     std = [0.229, 0.224, 0.225]
@@ -469,24 +312,63 @@ def _data_transforms_imagenet(datadir):
 
     return train_transform, valid_transform
 
-def _data_transforms_NIH():
+class ReducedDecode(object):
+    """
+    First step of an X-ray transform: decodes the lazily opened PIL image at
+    reduced resolution (see reduce_on_decode) before Resize touches it, or at
+    full resolution when reducing_gap is 0, and logs the decode throughput of
+    the process / DataLoader worker every `report_every` images.
+    """
+    # deterministic, so a SampleCache may keep its output
+    cacheable = True
+
+    def __init__(self, size, reducing_gap=2.0, report_every=1000):
+        self.size = size
+        self.reducing_gap = reducing_gap
+        self.report_every = report_every
+        self.decoded = 0
+        self.decode_time = 0.0
+
+    def __call__(self, img):
+        start = time.perf_counter()
+        if self.reducing_gap:
+            img = reduce_on_decode(img, self.size, self.reducing_gap)
+        else:
+            img.load()
+        self.decode_time += time.perf_counter() - start
+        self.decoded += 1
+        if self.report_every and self.decoded % self.report_every == 0:
+            worker_info = torch.utils.data.get_worker_info()
+            worker = 'worker {}'.format(worker_info.id) if worker_info is not None else 'pid {}'.format(os.getpid())
+            logging.info('decode {}: {} images, {:.1f} images/s'.format(worker, self.decoded, self.decoded / self.decode_time))
+        return img
+
+def _data_transforms_NIH(reducing_gap=2.0):
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
-    transform = transforms.Compose([
+    transform = transforms.Compose([ReducedDecode([150,150], reducing_gap),
                                     transforms.Resize([150,150]),
                                     transforms.ToTensor(),
                                     normalize])
     return transform
 
-def _data_transforms_ChexPert():
+def _data_transforms_ChexPert(reducing_gap=2.0):
     normalize = transforms.Normalize(mean=[0.485],
                                  std=[0.229])
-    transform = transforms.Compose([
+    transform = transforms.Compose([ReducedDecode([150,150], reducing_gap),
                                     transforms.Resize([150,150]),
                                     transforms.ToTensor(),
                                     normalize])
     return transform
 
+def _batch_transforms_NIH():
+    # the same normalization as _data_transforms_NIH, applied per batch to
+    # images read from an ImageCache
+    return NormalizeBatch(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+def _batch_transforms_ChexPert(channels=3):
+    return NormalizeBatch(mean=[0.485], std=[0.229], channels=channels)
+
 def load_data(datadir):
     if 'cifar' in datadir:
         train_transform, test_transform = _data_transforms_cifar(datadir)
@@ -501,196 +383,15 @@ def load_data(datadir):
 
     return (y_train, y_test)
 
-def partition_data(datadir, partition, n_nets, alpha):
-    logging.info("*********partition data***************")
-    
-
-    if partition == "homo":
-        total_num = n_train
-        idxs = np.random.permutation(total_num)
-        batch_idxs = np.array_split(idxs, n_nets)
-        net_dataidx_map = {i: batch_idxs[i] for i in range(n_nets)}
-
-    elif partition == "hetero":
-        net_dataidx_map = {}
-        min_size = 0
-        idx_batch = [[] for _ in range(n_nets)] # n_nuts : the number of clients
-        client_pos_proportions = []
-        client_pos_freq = []
-        client_neg_proportions = []
-        client_neg_freq = []
-        client_imbalances = []
-        # [[], [], [], [], [], [], [], [], [], []] # the number of clients
-        # for each class in the dataset
-        if 'NIH' in datadir or 'CheXpert' in datadir:
-            N = 86336
-            idx_k = np.array(list(range(N)))
-            np.random.shuffle(idx_k)
-            while min_size < 10:
-                proportions = np.random.dirichlet(np.repeat(alpha, n_nets))
-                proportions = np.array([p * (len(idx_j) < N / n_nets) for p, idx_j in zip(proportions, idx_batch)])
-                proportions = proportions / proportions.sum()
-                
-                proportions = (np.cumsum(proportions) * N).astype(int)[:-1]
-                idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-                min_size = min([len(idx_j) for idx_j in idx_batch])
-            
-            for j in range(n_nets):
-                np.random.shuffle(idx_batch[j]) # shuffle once more
-                net_dataidx_map[j] = idx_batch[j]
-                
-            return net_dataidx_map
-        
-        elif 'cifar100' in datadir:
-            long_tail = get_img_num_per_cls('100')
-            print("Long Tail: ", long_tail)
-            y_train, y_test = load_data(datadir)
-            n_train = y_train.shape[0]
-            n_test = y_test.shape[0]
-            class_num = len(np.unique(y_train))
-            min_size = 0
-            K = class_num
-            N = n_train
-            logging.info("N = " + str(N))
-            class_proportions = []
-            class_freq = []
-            
-            while min_size < 10:
-                proportionss = np.random.dirichlet(np.repeat(alpha, n_nets))
-                idx_batch = [[] for _ in range(n_nets)]
-                class_proportions = []
-                class_freq = []
-                class_neg_proportions = []
-                class_neg_freq = []
-                
-                for k in range(K): # partition for the class k
-                    idx_k = np.where(y_train == k)[0]
-                    np.random.shuffle(idx_k)
-                    idx_k = idx_k[:long_tail[k]]
-
-                    proportionss = np.random.dirichlet(np.repeat(alpha, n_nets))
-                    proportions = proportionss / proportionss.sum()
-
-                    class_proportions.append(proportions)
-                    class_freq.append((proportions * len(idx_k)).astype(int))
-                    class_neg_proportions.append(1 - proportions)
-                    class_neg_freq.append(((1 - proportions) * len(idx_k)).astype(int))
-                    
-                    min_data = min((proportions * len(idx_k)).astype(int))
-                    
-                    # Same as above
-                    proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-                    # cumsum : cumulative summation
-                    idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-
-                    # fivide idx_k according to the proportion
-                    min_size = min([len(idx_j) for idx_j in idx_batch])
-
-            client_pos_freq = np.array(class_freq)
-            client_pos_freq = client_pos_freq.T
-            client_neg_freq = np.array(class_neg_freq)
-            client_neg_freq = client_neg_freq.T
-
-            # Get clients' degree of data imbalances.
-            for i in range(n_nets):
-                difference_cnt = client_pos_freq[i] - client_pos_freq[i].mean()
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = difference_cnt[i] * difference_cnt[i]        
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = difference_cnt[i] / difference_cnt.sum()
-                # Calculate the level of imbalnce
-                difference_cnt -= difference_cnt.mean()
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = (difference_cnt[i] * difference_cnt[i])
-                client_imbalances.append(1 / difference_cnt.sum())
-
-            client_imbalances = np.array(client_imbalances)
-            client_imbalances =  client_imbalances / client_imbalances.sum()
-
-            for j in range(n_nets):
-                np.random.shuffle(idx_batch[j]) # shuffle once more
-                net_dataidx_map[j] = idx_batch[j]
-
-            traindata_cls_counts = record_net_data_stats(y_train, net_dataidx_map)
-
-            # the number of class, shuffled indices, record of it
-            return class_num, net_dataidx_map, traindata_cls_counts, client_pos_freq, client_neg_freq, client_imbalances
-
-        
-        elif 'cifar10' in datadir:
-            long_tail = get_img_num_per_cls('10')
-            print("Long tail:", long_tail)
-            y_train, y_test = load_data(datadir)
-            n_train = y_train.shape[0]
-            n_test = y_test.shape[0]
-            class_num = len(np.unique(y_train))
-            min_size = 0
-            K = class_num
-            N = n_train
-            logging.info("N = " + str(N))
-            while min_size < 10:
-                idx_batch = [[] for _ in range(n_nets)]
-                class_proportions = []
-                class_freq = []
-                class_neg_proportions = []
-                class_neg_freq = []
-                # proportionss = np.random.dirichlet(np.repeat(alpha, n_nets))
-                
-                for k in range(K): # partition for the class k
-                    idx_k = np.where(y_train == k)[0]
-                    np.random.shuffle(idx_k)
-                    proportionss = np.random.dirichlet(np.repeat(alpha, n_nets))
-                    proportions = proportionss / proportionss.sum()
-
-                    class_proportions.append(proportions)
-                    class_freq.append((proportions * len(idx_k)).astype(int))
-                    class_neg_proportions.append(1 - proportions)
-                    class_neg_freq.append(((1 - proportions) * len(idx_k)).astype(int))
-                    
-                    min_data = min((proportions * len(idx_k)).astype(int))
-                    
-                    # Same as above
-                    proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-                    # cumsum : cumulative summation
-                    idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-
-                    min_size = min([len(idx_j) for idx_j in idx_batch])
-
-            client_pos_freq = np.array(class_freq)
-            client_pos_freq = client_pos_freq.T
-            client_neg_freq = np.array(class_neg_freq)
-            client_neg_freq = client_neg_freq.T
-
-            # Get clients' degree of data imbalances.
-            for i in range(n_nets):
-                difference_cnt = client_pos_freq[i] - client_pos_freq[i].mean()
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = difference_cnt[i] * difference_cnt[i]        
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = difference_cnt[i] / difference_cnt.sum()
-                # Calculate the level of imbalnce
-                difference_cnt -= difference_cnt.mean()
-                for i in range(len(difference_cnt)):
-                    difference_cnt[i] = (difference_cnt[i] * difference_cnt[i])
-                client_imbalances.append(1 / difference_cnt.sum())
-
-            client_imbalances = np.array(client_imbalances)
-            client_imbalances =  client_imbalances / client_imbalances.sum()
-
-            for j in range(n_nets):
-                np.random.shuffle(idx_batch[j]) # shuffle once more
-                net_dataidx_map[j] = idx_batch[j]
-
-            traindata_cls_counts = record_net_data_stats(y_train, net_dataidx_map)
-
-            # the number of class, shuffled indices, record of it
-            return class_num, net_dataidx_map, traindata_cls_counts, client_pos_freq, client_neg_freq, client_imbalances
-
-# for centralized training
-def get_dataloader(datadir, train_bs, test_bs, dataidxs=None):
+def _loader_settings(datadir, batch_augment=False):
     ################datadir is the key to discern the dataset#######################
+    train_collate = test_collate = None
     if 'cifar' in datadir:
         train_transform, test_transform = _data_transforms_cifar(datadir)
+        if batch_augment:
+            # samples stay uint8 arrays; augmentation runs on whole batches
+            train_transform = test_transform = None
+            train_collate, test_collate = _batch_transforms_cifar(datadir)
         dl_obj = CIFAR_truncated
         workers=0
         persist=False
@@ -699,109 +400,284 @@ def get_dataloader(datadir, train_bs, test_bs, dataidxs=None):
         dl_obj = ImageFolder_custom
         workers=8
         persist=True
+    return dl_obj, (train_transform, train_collate), (test_transform, test_collate), workers, persist
+
+def get_train_dataloader(datadir, train_bs, dataidxs=None, batch_augment=False, **ds_kwargs):
+    dl_obj, (transform, collate), _, workers, persist = _loader_settings(datadir, batch_augment)
+    train_ds = dl_obj(datadir, dataidxs=dataidxs, train=True, transform=transform, download=True, **ds_kwargs)
+    # sharded images are shuffled one shard at a time
+    sampler = shard_sampler(train_ds)
+    # a client with less than a batch keeps its partial batch instead of
+    # training on none; an empty one is not shuffled (RandomSampler rejects it)
+    return data.DataLoader(dataset=train_ds, batch_size=train_bs, shuffle=sampler is None and len(train_ds) > 0, sampler=sampler,
+                           drop_last=len(train_ds) >= train_bs, num_workers=workers, persistent_workers=persist, collate_fn=collate)
+
+def get_test_dataloader(datadir, test_bs, batch_augment=False, **ds_kwargs):
+    dl_obj, _, (transform, collate), workers, persist = _loader_settings(datadir, batch_augment)
+    test_ds = dl_obj(datadir, train=False, transform=transform, download=True, **ds_kwargs)
+    return data.DataLoader(dataset=test_ds, batch_size=test_bs, shuffle=False, drop_last=True, num_workers=workers, persistent_workers=persist, collate_fn=collate)
 
-    train_ds = dl_obj(datadir, dataidxs=dataidxs, train=True, transform=train_transform, download=True)
-    test_ds = dl_obj(datadir, train=False, transform=test_transform, download=True)
-    
-    train_dl = data.DataLoader(dataset=train_ds, batch_size=train_bs, shuffle=True, drop_last=True, num_workers=workers, persistent_workers=persist)
-    test_dl = data.DataLoader(dataset=test_ds, batch_size=test_bs, shuffle=False, drop_last=True, num_workers=workers, persistent_workers=persist)
-
+# for centralized training
+def get_dataloader(datadir, train_bs, test_bs, dataidxs=None, batch_augment=False):
+    train_dl = get_train_dataloader(datadir, train_bs, dataidxs, batch_augment)
+    test_dl = get_test_dataloader(datadir, test_bs, batch_augment)
     return train_dl, test_dl
 
-def load_partition_data(data_dir, partition_method, partition_alpha, client_number, batch_size):
+# ids of the client-side transforms a DataSpec can build
+TRANSFORM_IDS = ('nih', 'nih_cached', 'chexpert', 'chexpert_cached', 'cifar', 'cifar_batch', 'imagenet')
 
+class DataSpec(object):
+    """
+    Everything a worker needs to build the loaders of any client itself:
+    the dataset root, the partition artifact, the id of the client
+    transforms and the loader settings. The client registries returned by
+    load_partition_data build through a DataSpec, so it is all a pool worker
+    receives; the partition, metadata and image stores are opened in the
+    worker the first time one of its clients is trained.
+
+    Args:
+        data_dir : dataset root
+        partition : path of the saved partition artifact, or the artifact
+                    itself when it was not saved (no partition seed)
+        transform_id : one of TRANSFORM_IDS
+        batch_size : batch size of the client loaders
+        reduced_decode : reducing gap of the X-ray decoding, see ReducedDecode;
+                         0 decodes at full resolution
+        channels : X-ray input channels
+        holdout : X-ray only, aligned with the partition index; the local
+                  sample order of each client, whose first 80% are trained on
+                  and the rest validated on
+        splits : CIFAR only, the (train, test) splits from load_cifar; their
+                 pixels are shared memory and are sent as handles
+        sample_cache : X-ray and 'imagenet' only, (budget in bytes, policy) of
+                       the SampleCache of the process that loads the images;
+                       None reads and decodes every image on every access
+
+    'imagenet' builds ImageFolder_custom clients from the partition index.
+    """
+    def __init__(self, data_dir, partition, transform_id, batch_size, reduced_decode=2.0, channels=3,
+                 holdout=None, splits=None, sample_cache=None):
+        if transform_id not in TRANSFORM_IDS:
+            raise ValueError('transform id must be one of ' + ', '.join(TRANSFORM_IDS))
+        self.data_dir = data_dir
+        self.partition = partition
+        self.transform_id = transform_id
+        self.batch_size = batch_size
+        self.reduced_decode = reduced_decode
+        self.channels = channels
+        self.holdout = holdout
+        self.splits = splits
+        self.sample_cache = sample_cache
+        self._artifact = None if isinstance(partition, str) else partition
+        self._resources = None
+        self._test_loader = None
+
+    @property
+    def is_xray(self):
+        return self.transform_id.startswith(('nih', 'chexpert'))
+
+    def dataset_kwargs(self, train):
+        # hand CIFAR datasets the split this spec was sent with, ImageFolder
+        # datasets the sample cache
+        if self.splits is not None:
+            return {'split': self.splits[0 if train else 1]}
+        if self.transform_id == 'imagenet' and self.sample_cache is not None:
+            return {'sample_cache': get_sample_cache(*self.sample_cache)}
+        return {}
+
+    def artifact(self):
+        if self._artifact is None:
+            with np.load(self.partition) as artifact:
+                self._artifact = {k: artifact[k] for k in ('indices', 'offsets')}
+        return self._artifact
+
+    @property
+    def num_clients(self):
+        return len(self.artifact()['offsets']) - 1
+
+    def client_range(self, client_idx):
+        offsets = self.artifact()['offsets']
+        return slice(offsets[client_idx], offsets[client_idx + 1])
+
+    def client_loaders(self):
+        # (train, test) {client_idx: DataLoader} registries
+        return ClientRegistry(self.num_clients, self.train_loader), ClientRegistry(self.num_clients, self.test_loader)
+
+    def resources(self):
+        """
+        X-ray metadata, image stores and transforms, opened once per process.
+        """
+        if self._resources is None:
+            cached = self.transform_id.endswith('_cached')
+            r = {'train_cache': None, 'test_cache': None, 'train_shards': None, 'test_shards': None, 'collate_fn': None,
+                 'sample_cache': get_sample_cache(*self.sample_cache) if self.sample_cache is not None and not cached else None}
+            if self.transform_id.startswith('nih'):
+                r['metadata'] = r['test_metadata'] = NIHMetadata(self.data_dir)
+                train_paths, test_paths = r['metadata'].train_val_paths, r['metadata'].test_paths
+                r['transform'] = _data_transforms_NIH(self.reduced_decode)
+                if cached:
+                    r['collate_fn'] = _batch_transforms_NIH()
+            else:
+                r['metadata'] = ChexpertMetadata(CHEXPERT_TRAIN_CSV)
+                r['test_metadata'] = ChexpertMetadata(CHEXPERT_TEST_CSV)
+                train_paths, test_paths = r['metadata'].paths, r['test_metadata'].paths
+                r['transform'] = _data_transforms_ChexPert(self.reduced_decode)
+                if cached:
+                    r['collate_fn'] = _batch_transforms_ChexPert(self.channels)
+            if cached:
+                # decode and resize every image once; datasets then slice the store
+                r['train_cache'] = ImageCache(train_paths, size=(150, 150), reducing_gap=self.reduced_decode)
+                r['test_cache'] = ImageCache(test_paths, size=(150, 150), reducing_gap=self.reduced_decode)
+            else:
+                # images packed by data_preprocessing/shards.py, if they were
+                for split, paths in (('train', train_paths), ('test', test_paths)):
+                    if has_shards(shard_dir(self.data_dir, split)):
+                        reader = open_shards(shard_dir(self.data_dir, split))
+                        if len(reader) != len(paths):
+                            raise ValueError('{} holds {} images, the metadata {}; pack the shards again'.format(
+                                reader.out_dir, len(reader), len(paths)))
+                        r[split + '_shards'] = reader
+            self._resources = r
+        return self._resources
+
+    def xray_dataset(self, client_idx, indices):
+        r = self.resources()
+        if self.transform_id.startswith('nih'):
+            return NIHTrainDataset(client_idx, self.data_dir, transform=r['transform'], indices=indices,
+                                   metadata=r['metadata'], cache=r['train_cache'], shards=r['train_shards'], sample_cache=r['sample_cache'])
+        return ChexpertTrainDataset(client_idx, transform=r['transform'], indices=indices,
+                                    metadata=r['metadata'], cache=r['train_cache'], channels=self.channels, shards=r['train_shards'],
+                                    sample_cache=r['sample_cache'])
+
+    def xray_split(self, client_idx, train):
+        # the client's train or validation rows of the partitioned pool
+        rows = self.client_range(client_idx)
+        indices, order = self.artifact()['indices'][rows], self.holdout[rows]
+        n_train = int(len(indices) * 0.8)
+        return indices[order[:n_train]] if train else indices[order[n_train:]]
+
+    def train_loader(self, client_idx):
+        if not self.is_xray:
+            dataidxs = self.artifact()['indices'][self.client_range(client_idx)]
+            train_dl = get_train_dataloader(self.data_dir, self.batch_size, dataidxs, self.transform_id == 'cifar_batch',
+                                            **self.dataset_kwargs(train=True))
+            logging.info("client_idx = %d, local_sample_number = %d, batch_num_train_local = %d" % (
+                client_idx, len(dataidxs), len(train_dl)))
+            return train_dl
+        data = self.xray_dataset(client_idx, self.xray_split(client_idx, train=True))
+        sampler = shard_sampler(data)
+        # a client with a single sample validates on it and has none to train on
+        return torch.utils.data.DataLoader(data, batch_size=self.batch_size, shuffle=sampler is None and len(data) > 0, sampler=sampler,
+                                           collate_fn=self.resources()['collate_fn'])
+
+    def test_loader(self, client_idx):
+        if not self.is_xray:
+            # every CIFAR/ImageFolder client is evaluated on the same test split, so one loader is shared
+            if self._test_loader is None:
+                self._test_loader = get_test_dataloader(self.data_dir, self.batch_size, self.transform_id == 'cifar_batch',
+                                                        **self.dataset_kwargs(train=False))
+            return self._test_loader
+        data = self.xray_dataset(client_idx, self.xray_split(client_idx, train=False))
+        return torch.utils.data.DataLoader(data, batch_size=self.batch_size, shuffle=False, collate_fn=self.resources()['collate_fn'])
+
+    def global_train_loader(self):
+        # the whole train pool (X-ray) or train split, as the server's global loader
+        if not self.is_xray:
+            return get_train_dataloader(self.data_dir, self.batch_size, None, self.transform_id == 'cifar_batch',
+                                        **self.dataset_kwargs(train=True))
+        r = self.resources()
+        if self.transform_id.startswith('nih'):
+            data = NIHTrainDataset(0, self.data_dir, transform=r['transform'], indices=np.arange(XRAY_TRAIN_NUM), metadata=r['metadata'],
+                                   cache=r['train_cache'], shards=r['train_shards'])
+        else:
+            data = ChexpertTrainDataset(0, transform=r['transform'], indices=np.arange(XRAY_TRAIN_NUM), metadata=r['metadata'],
+                                        cache=r['train_cache'], channels=self.channels, shards=r['train_shards'])
+        return torch.utils.data.DataLoader(data, batch_size=32, shuffle=True, collate_fn=r['collate_fn'])
+
+    def global_test_loader(self):
+        if not self.is_xray:
+            # the test loader the clients share
+            return self.test_loader(None)
+        r = self.resources()
+        if self.transform_id.startswith('nih'):
+            data = NIHTestDataset(self.data_dir, transform=r['transform'], metadata=r['test_metadata'], cache=r['test_cache'],
+                                  shards=r['test_shards'], sample_cache=r['sample_cache'])
+        else:
+            data = ChexpertTestDataset(transform=r['transform'], metadata=r['test_metadata'], cache=r['test_cache'],
+                                       channels=self.channels, shards=r['test_shards'], sample_cache=r['sample_cache'])
+        return torch.utils.data.DataLoader(data, batch_size=32, shuffle=False, collate_fn=r['collate_fn'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.partition, str):
+            state['_artifact'] = None
+        state['_resources'] = None
+        state['_test_loader'] = None
+        return state
+
+def load_partition_data(data_dir, partition_method, partition_alpha, client_number, batch_size, image_cache=False, reduced_decode=2.0, gray_input=False, batch_augment=False,
+                        seed=None, imb_factor=0.1, sample_cache=None):
+
+    name = dataset_name(data_dir)
+    artifact = load_partition(data_dir, partition_method, client_number, partition_alpha, seed, imb_factor)
+    # workers reload a saved partition by its path instead of receiving it
+    partition = artifact if seed is None else partition_path(data_dir, partition_method, client_number, partition_alpha, seed, imb_factor)
+    offsets = artifact['offsets']
     # get local dataset
-    data_local_num_dict = dict() ### form 봐서 맞춰줘야 함
-    train_data_local_dict = dict()
-    test_data_local_dict = dict()
-    data_imbalances = []
-    train_data_global = None
-    test_data_global = None
+    data_local_num_dict = dict(enumerate(np.diff(offsets).tolist())) ### form 봐서 맞춰줘야 함
     
-    if 'NIH' in data_dir:
-        class_num = 14
-        client_imbalances = []
+    if name in ('NIH', 'CheXpert'):
+        class_num = 14 if name == 'NIH' else 10
         client_pos_freq = []
         client_neg_freq = []
-        indices = partition_data(data_dir, partition_method, client_number, partition_alpha)
-        train_data_global = torch.utils.data.DataLoader(NIHTrainDataset(0, data_dir, transform = _data_transforms_NIH(), indices=list(range(86336))), batch_size = 32, shuffle = True)
-        test_data_global = torch.utils.data.DataLoader(NIHTestDataset(data_dir, transform = _data_transforms_NIH()), batch_size = 32, shuffle = not True)
-        train_data_num = len(train_data_global)
-        test_data_num = len(test_data_global)
-        # indices = distribute_indices(length, 1, client_number)
-        for i in range(client_number):
-            data = NIHTrainDataset(i, data_dir, transform = _data_transforms_NIH(), indices=indices[i])
-            total_ds_cnt = np.array(data.total_ds_cnt)
-            client_imbalances.append(data.imbalance)
-            train_percentage = 0.8
-            train_dataset, val_dataset = torch.utils.data.random_split(data, [int(len(data)*train_percentage), len(data)-int(len(data)*train_percentage)])
-            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size = 32, shuffle = True)
-            val_loader = torch.utils.data.DataLoader(val_dataset, batch_size = 32, shuffle = not True)
-            client_pos_freq.append(total_ds_cnt.tolist())
-            client_neg_freq.append((total_ds_cnt.sum() - total_ds_cnt).tolist())
-            train_data_local_dict[i] = train_loader
-            test_data_local_dict[i] = val_loader
-        client_imbalances = np.array(client_imbalances)
-        client_imbalances = client_imbalances / client_imbalances.sum()
-        client_imbalances = client_imbalances.tolist()
-
-    elif 'CheXpert' in data_dir:
-        class_num = 10
-        client_imbalances = []
-        client_pos_freq = []
-        client_neg_freq = []
-        indices = partition_data(data_dir, partition_method, client_number, partition_alpha)
-        train_data_global = torch.utils.data.DataLoader(ChexpertTrainDataset(0, transform = _data_transforms_ChexPert(), indices=list(range(86336))), batch_size = 32, shuffle = True)
-        test_data_global =  torch.utils.data.DataLoader(ChexpertTestDataset(transform = _data_transforms_ChexPert()), batch_size = 32, shuffle = not True)
+        holdout = []
+        transform_id = name.lower() + ('_cached' if image_cache else '')
+        spec = DataSpec(data_dir, partition, transform_id, 32, reduced_decode, channels=1 if gray_input else 3, sample_cache=sample_cache)
+        # read the metadata once; every client dataset slices it by its indices
+        r = spec.resources()
+        if name == 'NIH':
+            labels = r['metadata'].train_val_labels[:, :14] # without No Finding
+            n_test = len(r['test_metadata'].test_paths)
+        else:
+            labels = r['metadata'].labels
+            n_test = len(r['test_metadata'].paths)
+        # the server only evaluates on the test loader; both are built on first use
+        train_data_global = LazyLoader(spec.global_train_loader, -(-XRAY_TRAIN_NUM // 32))
+        test_data_global = LazyLoader(spec.global_test_loader, -(-n_test // 32))
         train_data_num = len(train_data_global)
         test_data_num = len(test_data_global)
-        # indices = distribute_indices(length, 1, client_number)
         for i in range(client_number):
-            data = ChexpertTrainDataset(i, transform = _data_transforms_ChexPert(), indices=indices[i])
-            client_imbalances.append(data.imbalance)
-            total_ds_cnt = np.array(data.total_ds_cnt)
+            total_ds_cnt = labels[artifact['indices'][offsets[i]:offsets[i + 1]]].sum(axis=0, dtype=np.int64)
             client_pos_freq.append(total_ds_cnt.tolist())
             client_neg_freq.append((total_ds_cnt.sum() - total_ds_cnt).tolist())
-            train_percentage = 0.8
-            train_dataset, val_dataset = torch.utils.data.random_split(data, [int(len(data)*train_percentage), len(data)-int(len(data)*train_percentage)])
-            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size = 32, shuffle = True)
-            val_loader = torch.utils.data.DataLoader(val_dataset, batch_size = 32, shuffle = not True)
-            train_data_local_dict[i] = train_loader
-            test_data_local_dict[i] = val_loader
-
-        client_imbalances = np.array(client_imbalances)
-        client_imbalances = client_imbalances / client_imbalances.sum()
-        client_imbalances = client_imbalances.tolist()
-
-    elif ('cifar10' in data_dir) or ('cifar100' in data_dir):
-        
-        class_num, net_dataidx_map, traindata_cls_counts, client_pos_freq, client_neg_freq, client_imbalances = partition_data(data_dir, partition_method, client_number, partition_alpha)
+            # the 80/20 train/validation split, drawn as torch.utils.data.random_split does
+            holdout.append(torch.randperm(int(offsets[i + 1] - offsets[i])).numpy())
+        spec.holdout = np.concatenate(holdout)
+
+        client_imbalances = imbalance_weights(client_pos_freq).tolist()
+
+    else:
+        class_num = int(artifact['class_num'])
+        client_pos_freq, client_neg_freq = artifact['client_pos_freq'], artifact['client_neg_freq']
+        client_imbalances = artifact['client_imbalances']
+        traindata_cls_counts = record_net_data_stats(artifact['cls_counts'])
         logging.info("traindata_cls_counts = " + str(traindata_cls_counts)) # report the data
-        train_data_num = sum([len(net_dataidx_map[r]) for r in range(client_number)]) # overall number of data
+        train_data_num = int(offsets[-1]) # overall number of data
         
         # use traindata_cls_counts to calculate the degree of imbalance
 
-        train_data_global, test_data_global = get_dataloader(data_dir, batch_size, batch_size) # get the global data
+        splits = (load_cifar(data_dir, train=True, download=True), load_cifar(data_dir, train=False, download=True))
+        spec = DataSpec(data_dir, partition, 'cifar_batch' if batch_augment else 'cifar', batch_size, splits=splits)
+        # get the global data; loaders drop the last partial batch
+        train_data_global = LazyLoader(spec.global_train_loader, len(splits[0][1]) // batch_size)
+        test_data_global = LazyLoader(spec.global_test_loader, len(splits[1][1]) // batch_size)
         logging.info("train_dl_global number = " + str(len(train_data_global)))
         logging.info("test_dl_global number = " + str(len(train_data_global)))
         test_data_num = len(test_data_global)
 
-        for client_idx in range(client_number):
-            dataidxs = net_dataidx_map[client_idx]
-            print(dataidxs)
-            local_data_num = len(dataidxs)
-            data_local_num_dict[client_idx] = local_data_num
-            logging.info("client_idx = %d, local_sample_number = %d" % (client_idx, local_data_num))
-
-            # training batch size = 64; algorithms batch size = 32
-            train_data_local, test_data_local = get_dataloader(data_dir, batch_size, batch_size, dataidxs)
-            logging.info("client_idx = %d, batch_num_train_local = %d, batch_num_test_local = %d" % (
-                client_idx, len(train_data_local), len(test_data_local)))
-            train_data_local_dict[client_idx] = train_data_local # client_number : dataloader
-            test_data_local_dict[client_idx] = test_data_local
-
-    else :
-        raise ValueError("Wrong data path!")
+    # client loaders are only built when a client is first trained, in the
+    # process that trains it
+    train_data_local_dict, test_data_local_dict = spec.client_loaders() # client_number : dataloader
 
     return train_data_num, test_data_num, train_data_global, test_data_global, \
            data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num, client_pos_freq, client_neg_freq, client_imbalances
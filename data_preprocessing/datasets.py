@@ -4,12 +4,18 @@ Code based on https://github.com/FedML-AI/FedML
 '''
 
 
+import hashlib
 import logging
+import os
 import numpy as np
+import torch
 import torch.utils.data as data
 from torchvision.datasets import CIFAR10
 from torchvision.datasets import CIFAR100
 from torchvision.datasets import DatasetFolder, ImageFolder
+from torchvision.datasets.folder import default_loader, make_dataset
+from data_preprocessing import config
+from data_preprocessing.shards import has_shards, open_shards, shard_dir
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -17,9 +23,110 @@ logger.setLevel(logging.INFO)
 
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
 
+# (root, train) -> (data, target) of every CIFAR split loaded in this process
+_cifar_splits = {}
+
+def load_cifar(root, train=True, download=False):
+    """
+    Load a CIFAR-10/100 split once per process.
+
+    Returns:
+        data : (N, 32, 32, 3) uint8 tensor in shared memory; passing it to a
+               worker process sends a handle, not the pixels
+        target : (N,) int64 array
+    """
+    key = (root, train)
+    if key not in _cifar_splits:
+        print("download = " + str(download))
+        if "cifar100" in root:
+            cifar_dataobj = CIFAR100(root, train, download=download)
+        else:
+            cifar_dataobj = CIFAR10(root, train, download=download)
+        data = torch.from_numpy(cifar_dataobj.data).share_memory_()
+        target = np.array(cifar_dataobj.targets, dtype=np.int64)
+        _cifar_splits[key] = (data, target)
+    return _cifar_splits[key]
+
+# folder (or manifest) -> index of every image folder loaded in this process
+_folder_indices = {}
+
+def folder_signature(folder):
+    # class directories and their modification times; adding or removing an
+    # image changes the time of its directory
+    entries = sorted((e for e in os.scandir(folder) if e.is_dir()), key=lambda e: e.name)
+    return '|'.join('{}:{}'.format(e.name, e.stat().st_mtime_ns) for e in entries)
+
+def load_folder_index(folder):
+    """
+    Index of an ImageFolder tree (folder/<class>/<image>), in the order
+    ImageFolder lists it. Scanned once per folder and saved under
+    config.pkl_dir_path, then loaded once per process.
+
+    Returns:
+        paths : (N,) image paths relative to folder, as bytes
+        targets : (N,) int64 class indices
+    """
+    folder = os.path.abspath(folder)
+    if folder in _folder_indices:
+        return _folder_indices[folder]
+
+    key = hashlib.sha1(folder.encode()).hexdigest()[:16]
+    path = os.path.join(config.pkl_dir_path, 'folder_index_{}.npz'.format(key))
+    signature = folder_signature(folder)
+    index = None
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if str(cached['signature']) == signature:
+                index = (cached['paths'], cached['targets'])
+    if index is None:
+        logging.info('indexing image folder {}'.format(folder))
+        classes = sorted(e.name for e in os.scandir(folder) if e.is_dir())
+        samples = make_dataset(folder, {c: i for i, c in enumerate(classes)}, extensions=IMG_EXTENSIONS)
+        index = (np.array([os.path.relpath(p, folder).encode() for p, _ in samples], dtype=bytes),
+                 np.array([t for _, t in samples], dtype=np.int64))
+        if not os.path.exists(config.pkl_dir_path):
+            os.makedirs(config.pkl_dir_path, exist_ok=True)
+        tmp_path = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_path, signature=np.array(signature), paths=index[0], targets=index[1])
+        os.replace(tmp_path, path)
+    _folder_indices[folder] = index
+    return index
+
+# {root}/{split}_manifest.npz: a virtual subset of another image folder,
+# written by gen_imagenet_subset --mode virtual
+SUBSET_MANIFEST = '{}_manifest.npz'
+
+def load_subset_manifest(path):
+    """
+    Returns:
+        folder : the image folder the subset was drawn from
+        paths, targets : as load_folder_index, relative to folder
+    """
+    path = os.path.abspath(path)
+    if path not in _folder_indices:
+        with np.load(path) as manifest:
+            _folder_indices[path] = (str(manifest['folder']), manifest['paths'], manifest['targets'])
+    return _folder_indices[path]
+
+def load_image_folder(root, split):
+    """
+    Images of the split of an ImageFolder root: a virtual subset if root has
+    a manifest for it, root/split otherwise.
+
+    Returns:
+        folder : the image folder the paths are relative to
+        paths, targets : as load_folder_index
+    """
+    manifest = os.path.join(root, SUBSET_MANIFEST.format(split))
+    if os.path.exists(manifest):
+        # a virtual subset; the images stay where they were drawn from
+        return load_subset_manifest(manifest)
+    folder = os.path.join(root, split)
+    return (folder,) + load_folder_index(folder)
+
 class CIFAR_truncated(data.Dataset):
 
-    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
+    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False, split=None):
 
         self.root = root
         self.dataidxs = dataidxs
@@ -28,36 +135,30 @@ class CIFAR_truncated(data.Dataset):
         self.target_transform = target_transform
         self.download = download
 
-        self.data, self.target = self.__build_truncated_dataset__()
-
-    def __build_truncated_dataset__(self):
-        print("download = " + str(self.download))
-        if "cifar100" in self.root:
-            cifar_dataobj = CIFAR100(self.root, self.train, self.transform, self.target_transform, self.download)
-        else:
-            cifar_dataobj = CIFAR10(self.root, self.train, self.transform, self.target_transform, self.download)
-
+        self.data, self.target = self.__build_truncated_dataset__(split)
 
-        if self.train:
-            # print("train member of the class: {}".format(self.train))
-            # data = cifar_dataobj.train_data
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
+    def __build_truncated_dataset__(self, split=None):
+        # every client indexes the same shared split instead of copying its
+        # rows out of it; self.indices maps a local index to a row of self.data
+        # split: (data, target) of an already loaded split, as load_cifar returns it
+        if split is not None:
+            data, target = split
         else:
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
+            data, target = load_cifar(self.root, self.train, self.download)
 
+        self.indices = None
         if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
+            self.indices = np.asarray(self.dataidxs, dtype=np.int64)
+            target = target[self.indices]
 
         return data, target
 
     def truncate_channel(self, index):
+        # note: this writes to the split shared by all clients
         for i in range(index.shape[0]):
-            gs_index = index[i]
-            self.data[gs_index, :, :, 1] = 0.0
-            self.data[gs_index, :, :, 2] = 0.0
+            gs_index = index[i] if self.indices is None else self.indices[index[i]]
+            self.data[gs_index, :, :, 1] = 0
+            self.data[gs_index, :, :, 2] = 0
 
     def __getitem__(self, index):
         """
@@ -67,7 +168,8 @@ class CIFAR_truncated(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        img, target = self.data[index], self.target[index]
+        row = index if self.indices is None else self.indices[index]
+        img, target = self.data[row].numpy(), self.target[index]
 
         if self.transform is not None:
             img = self.transform(img)
@@ -78,42 +180,57 @@ class CIFAR_truncated(data.Dataset):
         return img, target
 
     def __len__(self):
-        return len(self.data)
+        return len(self.target)
 
 # Imagenet
 class ImageFolder_custom(DatasetFolder):
-    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
+    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False, sample_cache=None):
         self.root = root
         self.dataidxs = dataidxs
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
-
-        if self.train:
-            imagefolder_obj = ImageFolder(self.root+'/train', self.transform)
+        self.sample_cache = sample_cache
+
+        split = 'train' if self.train else 'val'
+        self.loader = default_loader
+        self.shards = None
+        self.shard_ids = None
+        if has_shards(shard_dir(self.root, split)):
+            # packed by data_preprocessing/shards.py, in the order of the folder index
+            self.shards = open_shards(shard_dir(self.root, split))
+            self.folder, paths, target = None, self.shards.paths, self.shards.targets
         else:
-            imagefolder_obj = ImageFolder(self.root+'/val', self.transform)
-        self.loader = imagefolder_obj.loader
+            # every client slices the same cached index of the folder
+            self.folder, paths, target = load_image_folder(self.root, split)
+        self.rows = np.arange(len(target))
         if self.dataidxs is not None:
-            self.samples = np.array(imagefolder_obj.samples)[self.dataidxs]
-        else:
-            self.samples = np.array(imagefolder_obj.samples)
-        self.target = self.samples[:,1].astype(np.int64)
+            self.rows = np.asarray(self.dataidxs, dtype=np.int64)
+            paths, target = paths[self.rows], target[self.rows]
+        if self.shards is not None:
+            self.shard_ids = self.shards.shard[self.rows]
+        self.paths = paths
+        self.target = target
 
     def __getitem__(self, index):
-        path = self.samples[index][0]
-        target = self.samples[index][1]
-        target = int(target)
-        sample = self.loader(path)
-        if self.transform is not None:
-            sample = self.transform(sample)
+        target = self.target[index]
+        if self.shards is not None:
+            open_image = lambda: self.shards.image(self.rows[index]).convert('RGB')
+            size = lambda: int(self.shards.size[self.rows[index]])
+        else:
+            path = os.path.join(self.folder, self.paths[index].decode())
+            open_image = lambda: self.loader(path)
+            size = lambda: os.path.getsize(path)
+        if self.sample_cache is not None:
+            sample = self.sample_cache.load(self.paths[index], open_image, self.transform, size)
+        else:
+            sample = open_image()
+            if self.transform is not None:
+                sample = self.transform(sample)
         if self.target_transform is not None:
             target = self.target_transform(target)
 
         return sample, target
 
     def __len__(self):
-        if self.dataidxs is None:
-            return len(self.samples)
-        else:
-            return len(self.dataidxs)
\ No newline at end of file
+        return len(self.target)
\ No newline at end of file
@@ -1,18 +1,88 @@
+'''
+Build the 200-class ImageNet subset under data/imagenet200
+
+    python -m data_preprocessing.gen_imagenet_subset --data_dir path/to/ImageNet [--mode link|reflink|copy|virtual]
+
+Images are hard-linked into the subset when it is on the same file system
+as ImageNet, reflinked (copy-on-write clone) where the file system
+supports it, and copied by a thread pool otherwise. --mode virtual copies
+nothing and writes a manifest per split that ImageFolder_custom reads.
+'''
+import argparse
 import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import torchvision.datasets as datasets
+from torchvision.datasets.folder import IMG_EXTENSIONS
+from data_preprocessing.datasets import SUBSET_MANIFEST
+try:
+    import fcntl
+except ImportError: # not on Windows; falls back to copying
+    fcntl = None
+
+FICLONE = 0x40049409 # linux/fs.h: share the extents of another file (reflink)
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def place(src, dst, mode='link'):
+    """
+    Put the image src at dst with the cheapest method `mode` allows.
+
+    Returns:
+        the method used: link, reflink, copy or exists
+    """
+    if os.path.exists(dst):
+        return 'exists'
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError: # e.g. another file system
+            pass
+    if mode in ('link', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    return 'copy'
 
+def write_manifest(path, folder, classes, images):
+    """
+    Virtual subset of one split: images (class, file name) of `folder`,
+    listed in the order ImageFolder would list a materialized copy.
+    """
+    class_idx = {c: i for i, c in enumerate(sorted(classes))}
+    images = sorted((c, im) for c, im in images if im.lower().endswith(IMG_EXTENSIONS))
+    np.savez(path, folder=np.array(os.path.abspath(folder)), classes=np.array(sorted(classes)),
+             paths=np.array([os.path.join(c, im).encode() for c, im in images], dtype=bytes),
+             targets=np.array([class_idx[c] for c, _ in images], dtype=np.int64))
+    return len(images)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, default='path/to/ImageNet',
             help='path to ImageNet wirh train and val folders')
+    parser.add_argument('--mode', type=str, default='link', choices=['link', 'reflink', 'copy', 'virtual'],
+            help='link: hard link, else reflink, else copy; reflink: reflink, else copy; copy; virtual: write manifests only')
+    parser.add_argument('--threads', type=int, default=16,
+            help='number of threads placing images')
     args = parser.parse_args()
+    data_dir = args.data_dir
+    start = time.time()
 
     # Data loading code
     traindir = os.path.join(data_dir, 'train')
-    train_dataset = datasets.ImageFolder(traindir, None)
-    classes = train_dataset.classes
+    # the class folders, sorted as datasets.ImageFolder(traindir).classes lists them
+    classes = sorted(entry.name for entry in os.scandir(traindir) if entry.is_dir())
     print("the number of total classes: {}".format(len(classes)))
 
     seed = 1993
@@ -26,23 +96,35 @@ if __name__ == '__main__':
     if not os.path.exists(des_root_dir):
         os.makedirs(des_root_dir)
     phase_list = ['train', 'val']
+    # draw the images of every phase first (same draws as before), then place them
+    selected = {}
     for phase in phase_list:
-        if not os.path.exists(os.path.join(des_root_dir, phase)):
-            os.mkdir(os.path.join(des_root_dir, phase))
+        selected[phase] = []
         for idx, sc in enumerate(subset_classes):
-            print('{}/{} class: {}'.format(idx, subset_num, sc))
-            if not os.path.exists(os.path.join(des_root_dir, phase, sc)):
-                os.mkdir(os.path.join(des_root_dir, phase,sc))
-            src_dir = os.path.join(data_dir, phase, sc)
             imgs = os.listdir(os.path.join(data_dir, phase, sc))
             if phase=='train':
                 imgs = np.random.choice(imgs, 500, replace=False)
-            for im in imgs:
-                src_img = os.path.join(data_dir, phase, sc, im)
-                des_dir = os.path.join(des_root_dir, phase, sc, im)
-                cmd = "cp -r {} {}".format(src_img, des_dir)
-                # print(cmd)
-                os.system(cmd)
+            selected[phase].extend((sc, im) for im in imgs)
+
+    methods = Counter()
+    for phase in phase_list:
+        if args.mode == 'virtual':
+            path = os.path.join(des_root_dir, SUBSET_MANIFEST.format(phase))
+            n = write_manifest(path, os.path.join(data_dir, phase), subset_classes, selected[phase])
+            print('{}: {} images listed in {}'.format(phase, n, path))
+            methods['listed'] += n
+            continue
+        for sc in subset_classes:
+            if not os.path.exists(os.path.join(des_root_dir, phase, sc)):
+                os.makedirs(os.path.join(des_root_dir, phase, sc))
+        jobs = [(os.path.join(data_dir, phase, sc, im), os.path.join(des_root_dir, phase, sc, im)) for sc, im in selected[phase]]
+        # links and reflinks are metadata operations; copies overlap their I/O
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            methods.update(pool.map(lambda job: place(job[0], job[1], args.mode), jobs))
+        print('{}: {} images placed'.format(phase, len(jobs)))
+
+    print('generated {} in {:.1f}s ({})'.format(des_root_dir, time.time() - start,
+                                                ', '.join('{} {}'.format(n, m) for m, n in sorted(methods.items()))))
 
 # List of the 200 classes
 # ['n01729322' 'n01514668' 'n04550184' 'n03109150' 'n01990800' 'n02363005'
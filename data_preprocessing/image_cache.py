@@ -0,0 +1,160 @@
+'''
+Memory-mapped store of decoded and resized chest X-rays
+'''
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from data_preprocessing import config
+
+def cache_key(paths, size, mode, resample, reducing_gap=0):
+    # the store is keyed by every source path (in order) and the transform
+    # parameters, so a row of the store is the row of the same metadata index
+    params = '{}|{}|{}'.format(tuple(size), mode, int(resample))
+    if reducing_gap:
+        params += '|{}'.format(float(reducing_gap))
+    h = hashlib.sha1(params.encode())
+    for path in paths:
+        h.update(str(path).encode())
+        h.update(b'\n')
+    return h.hexdigest()[:16]
+
+def reduce_on_decode(img, size, reducing_gap=2.0):
+    """
+    Decode `img` (freshly opened, not loaded yet) at the lowest resolution
+    that is still at least `reducing_gap` times the (H, W) target `size`.
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg (draft mode);
+    other formats are decoded fully and shrunk by an integer factor with
+    Image.reduce, which is much cheaper than the final bilinear resize.
+    """
+    min_w, min_h = int(size[1] * reducing_gap), int(size[0] * reducing_gap)
+    img.draft(None, (min_w, min_h))
+    img.load()
+    factor = min(img.width // min_w, img.height // min_h)
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
+
+def decode_image(path, size, mode='L', resample=Image.BILINEAR, reducing_gap=0):
+    """
+    Decode one image and resize it the way transforms.Resize(size) does.
+
+    Returns:
+        (H, W) uint8 array
+    """
+    with Image.open(path) as img:
+        if reducing_gap:
+            img = reduce_on_decode(img, size, reducing_gap)
+        img = img.convert(mode).resize((size[1], size[0]), resample)
+        return np.asarray(img)
+
+class ImageCache(object):
+    """
+    (N, H, W) uint8 images, decoded and resized once and stored as an .npy
+    file next to a json manifest. The store is opened memory-mapped and
+    read-only, so every client dataset and DataLoader worker shares the same
+    pages and only slices it; normalization happens per batch in
+    NormalizeBatch.
+
+    Args:
+        paths : (N,) source image paths, row i of the store is paths[i]
+        size : (H, W) of the stored images
+        mode : PIL mode the images are converted to before resizing
+        reducing_gap : if set, decode at reduced resolution, see reduce_on_decode
+    """
+    def __init__(self, paths, size=(150, 150), mode='L', resample=Image.BILINEAR,
+                 cache_dir=config.image_cache_dir, num_threads=8, reducing_gap=0):
+        self.size = tuple(size)
+        self.mode = mode
+        self.resample = int(resample)
+        self.reducing_gap = float(reducing_gap)
+        self.count = len(paths)
+        key = cache_key(paths, self.size, self.mode, self.resample, self.reducing_gap)
+        self.path = os.path.join(cache_dir, 'images_{}.npy'.format(key))
+        self.manifest_path = os.path.join(cache_dir, 'images_{}.json'.format(key))
+        self._images = None
+
+        if not self.is_complete():
+            self.build(paths, num_threads)
+
+    def manifest(self):
+        return {'count': self.count, 'size': list(self.size), 'mode': self.mode, 'resample': self.resample,
+                'reducing_gap': self.reducing_gap}
+
+    def is_complete(self):
+        if not (os.path.exists(self.path) and os.path.exists(self.manifest_path)):
+            return False
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+        return all(manifest.get(k) == v for k, v in self.manifest().items())
+
+    def build(self, paths, num_threads=8):
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        logging.info('building image cache {} ({} images)'.format(self.path, self.count))
+        start = time.time()
+        tmp_path = self.path[:-len('.npy')] + '.{}.tmp.npy'.format(os.getpid())
+        store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(self.count,) + self.size)
+
+        def fill(i):
+            store[i] = decode_image(paths[i], self.size, self.mode, self.resample, self.reducing_gap)
+
+        # PIL releases the GIL while decoding and resizing
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(fill, range(self.count)))
+        store.flush()
+        del store
+        os.replace(tmp_path, self.path)
+
+        manifest = self.manifest()
+        manifest['build_seconds'] = round(time.time() - start, 2)
+        tmp_path = self.manifest_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        logging.info('image cache built in {:.1f}s ({:.0f} images/s)'.format(
+            manifest['build_seconds'], self.count / max(manifest['build_seconds'], 1e-6)))
+
+    @property
+    def images(self):
+        # opened lazily so that pickling a dataset into a worker process only
+        # ships the file name, not the images
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __getitem__(self, rows):
+        return self.images[rows]
+
+    def __len__(self):
+        return self.count
+
+class NormalizeBatch(object):
+    """
+    collate_fn for datasets backed by an ImageCache: stacks the uint8 image
+    views of a batch, then scales and normalizes the whole batch at once.
+    Single-channel images are broadcast to `channels` channels.
+    """
+    def __init__(self, mean, std, channels=3):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.channels = channels
+
+    def __call__(self, batch):
+        images, targets = zip(*batch)
+        images = torch.from_numpy(np.stack(images)).unsqueeze(1).float().div_(255)
+        images = (images - self.mean).div_(self.std)
+        if images.shape[1] != self.channels:
+            images = images.expand(-1, self.channels, -1, -1)
+        return images, torch.stack(targets)
@@ -0,0 +1,121 @@
+'''
+Metadata indices for the chest X-ray datasets
+'''
+import glob
+import logging
+import os
+import numpy as np
+from data_preprocessing import config
+
+NIH_CLASSES = ['Cardiomegaly','Emphysema','Effusion','Hernia','Infiltration','Mass','Nodule','Atelectasis','Pneumothorax','Pleural_Thickening','Pneumonia','Fibrosis','Edema','Consolidation', 'No Finding']
+NIH_TRAIN_VAL_LIST = 'data/NIH/train_val_list(original)'
+NIH_TEST_LIST = os.path.join('data/NIH', 'test_list.txt')
+
+SPLIT_TRAIN_VAL = 0
+SPLIT_TEST = 1
+
+CHEXPERT_TRAIN_CSV = "data/CheXpert-v1.0-small/selected_train.csv"
+CHEXPERT_TEST_CSV = "data/CheXpert-v1.0-small/selected_test.csv"
+
+def file_signature(paths):
+    # size and modification time of every source file; the cached index is
+    # rebuilt whenever one of them changes
+    signature = []
+    for path in paths:
+        st = os.stat(path)
+        signature.append('{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns))
+    return '|'.join(signature)
+
+def read_list(path):
+    with open(path, 'r') as f:
+        return str.split(f.read(), '\n')
+
+def build_nih_index(data_dir):
+    """
+    Join Data_Entry_2017.csv with the images on disk and the train_val/test
+    lists in one pass.
+
+    Returns:
+        dict with
+            paths  : (N,) image paths
+            labels : (N, 15) uint8 multi-hot labels, columns as NIH_CLASSES
+            split  : (N,) int8, SPLIT_TRAIN_VAL or SPLIT_TEST
+    """
+    import pandas as pd # only needed when the index is (re)built
+    csv_path = os.path.join(data_dir, 'Data_Entry_2017.csv')
+    all_xray_df = pd.read_csv(csv_path, usecols=['Image Index', 'Finding Labels'])
+
+    df = pd.DataFrame()
+    df['image_links'] = glob.glob(os.path.join(data_dir, 'images*', '*', '*.png'))
+    df['Image Index'] = df['image_links'].str[-16:]
+    merged_df = df.merge(all_xray_df, how = 'inner', on = ['Image Index'])
+
+    filenames = merged_df['image_links'].map(os.path.basename)
+    split = np.full(len(merged_df), -1, dtype=np.int8)
+    split[filenames.isin(set(read_list(NIH_TRAIN_VAL_LIST))).values] = SPLIT_TRAIN_VAL
+    split[filenames.isin(set(read_list(NIH_TEST_LIST))).values] = SPLIT_TEST
+    keep = split >= 0
+
+    labels = merged_df['Finding Labels'].str.get_dummies(sep='|')
+    labels = labels.reindex(columns=NIH_CLASSES, fill_value=0).values.astype(np.uint8)
+
+    return {'paths': merged_df['image_links'].to_numpy(dtype=str)[keep],
+            'labels': labels[keep],
+            'split': split[keep]}
+
+def load_nih_index(data_dir):
+    path = os.path.join(config.pkl_dir_path, config.nih_index_path)
+    sources = [os.path.join(data_dir, 'Data_Entry_2017.csv'), NIH_TRAIN_VAL_LIST, NIH_TEST_LIST]
+    signature = file_signature(sources)
+    if os.path.exists(path):
+        with np.load(path) as index:
+            if str(index['signature']) == signature:
+                return {k: index[k] for k in ('paths', 'labels', 'split')}
+
+    print('\nbuilding {}...'.format(config.nih_index_path))
+    index = build_nih_index(data_dir)
+    if not os.path.exists(config.pkl_dir_path):
+        os.makedirs(config.pkl_dir_path)
+    tmp_path = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+    np.savez(tmp_path, signature=np.array(signature), **index)
+    os.replace(tmp_path, path)
+    return index
+
+class NIHMetadata(object):
+    """
+    Paths and labels of both NIH splits, loaded once and shared by every
+    client dataset, which only keeps the rows of its own indices.
+    """
+    def __init__(self, data_dir):
+        index = load_nih_index(data_dir)
+        train_val = index['split'] == SPLIT_TRAIN_VAL
+        test = index['split'] == SPLIT_TEST
+        self.train_val_paths = index['paths'][train_val]
+        self.train_val_labels = index['labels'][train_val]
+        self.test_paths = index['paths'][test]
+        self.test_labels = index['labels'][test]
+
+class ChexpertMetadata(object):
+    """
+    Image paths and (N, 10) uint8 label matrix of a CheXpert csv, read once
+    and shared by every client dataset. Blank labels (not mentioned) and
+    uncertain ones (-1) are read as negative (0), with a warning, so that
+    counts, loss tables and targets only ever see 0 and 1; any other value
+    is rejected.
+    """
+    def __init__(self, csv_path=CHEXPERT_TRAIN_CSV, root="data/"):
+        import pandas as pd
+        df = pd.read_csv(csv_path)
+        labels = df.iloc[:, 2:].to_numpy(dtype=np.float32)
+        self.classes = list(df.columns[2:])
+        self.paths = (root + df['Path']).to_numpy(dtype=str)
+        blank = np.isnan(labels)
+        uncertain = labels == -1
+        if blank.any() or uncertain.any():
+            logging.warning('{}: {} blank and {} uncertain (-1) labels are read as 0'.format(
+                csv_path, int(blank.sum()), int(uncertain.sum())))
+            labels[blank | uncertain] = 0
+        if not np.isin(labels, (0, 1)).all():
+            raise ValueError('{} has labels other than 0, 1, -1 or blank: {}'.format(
+                csv_path, np.unique(labels[~np.isin(labels, (0, 1))]).tolist()))
+        self.labels = np.ascontiguousarray(labels, dtype=np.uint8)
@@ -0,0 +1,321 @@
+'''
+Dirichlet partitioning of the training sets across clients
+'''
+import logging
+import os
+import numpy as np
+from data_preprocessing import config
+from data_preprocessing.datasets import load_cifar
+
+# size of the NIH/CheXpert training pool that is partitioned
+XRAY_TRAIN_NUM = 86336
+
+def distribute_indices(length, alpha, client_number=5):
+    # split range(length) across client_number clients with Dirichlet(alpha) ratios
+    ratios = np.round(np.random.dirichlet(np.repeat(alpha, client_number))*length).astype(int)
+    ratios[-1] += length - ratios.sum()
+    indices = np.random.permutation(length)
+    return np.split(indices, np.cumsum(ratios)[:-1])
+
+def check_version(cifar_version):
+    if cifar_version not in ['10', '100', '20']:
+        raise ValueError('cifar version must be one of 10, 20, 100.')
+
+def img_num(cifar_version):
+    check_version(cifar_version)
+    dt = {'10': 5000, '100': 500, '20': 2500}
+    return dt[cifar_version]
+
+def get_img_num_per_cls(cifar_version, imb_factor=0.1):
+    """
+    Get a list of image numbers for each class, given cifar version
+    Num of imgs follows emponential distribution
+    img max: 5000 / 500 * e^(-lambda * 0);
+    img min: 5000 / 500 * e^(-lambda * int(cifar_version - 1))
+    exp(-lambda * (int(cifar_version) - 1)) = img_max / img_min
+    args:
+      cifar_version: str, '10', '100', '20'
+      imb_factor: float, imbalance factor: img_min/img_max,
+        None if geting default cifar data number
+    output:
+      img_num_per_cls: a list of number of images per class
+    """
+    cls_num = int(cifar_version)
+    img_max = img_num(cifar_version)
+    if imb_factor is None:
+        return [img_max] * cls_num
+    img_num_per_cls = []
+    for cls_idx in range(cls_num):
+        num = img_max * (imb_factor**(cls_idx / (cls_num - 1.0)))
+        img_num_per_cls.append(int(num))
+    return img_num_per_cls
+
+def get_imbalance(ds_cnt):
+    """
+    Level of class imbalance of a client from its per-class sample counts.
+    """
+    difference_cnt = np.asarray(ds_cnt, dtype=np.float64)
+    difference_cnt = difference_cnt - difference_cnt.mean()
+    difference_cnt = difference_cnt * difference_cnt
+    # Normalize the imbalance; every element is divided by the current sum,
+    # which already contains the normalized earlier elements, so this stays a
+    # (class-length) loop to keep the imbalance weights unchanged
+    for i in range(len(difference_cnt)):
+        difference_cnt[i] = difference_cnt[i] / difference_cnt.sum()
+    # Calculate the level of imbalnce
+    difference_cnt -= difference_cnt.mean()
+    return 1 / (difference_cnt * difference_cnt).sum()
+
+def imbalance_weights(client_counts):
+    """
+    Harmony weights of the clients: their get_imbalance levels, normalized
+    to sum to 1.
+
+    A client whose class counts are all equal (e.g. all 0, for an X-ray
+    client with only "No Finding" samples or a CIFAR client whose
+    frequencies round down to 0) has no defined imbalance and gets weight
+    0, with a warning, instead of turning every weight into NaN.
+
+    Args:
+        client_counts : (n_clients, num_classes) per-class counts
+    Returns:
+        (n_clients,) float64 array
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.array([get_imbalance(counts) for counts in client_counts], dtype=np.float64)
+    undefined = ~np.isfinite(weights)
+    if undefined.any():
+        logging.warning('{} of {} clients have equal counts in every class; their imbalance weight is 0'.format(
+            int(undefined.sum()), len(weights)))
+    weights[undefined] = 0
+    if weights.sum() > 0:
+        weights = weights / weights.sum()
+    return weights
+
+def record_net_data_stats(cls_counts):
+    # {client: {class: count}} of the classes a client holds
+    net_cls_counts = {}
+    for net_i, counts in enumerate(cls_counts):
+        net_cls_counts[net_i] = {k: counts[k] for k in np.nonzero(counts)[0]}
+    logging.debug('Data statistics: %s' % str(net_cls_counts))
+    return net_cls_counts
+
+def dataset_name(datadir):
+    for name in ('NIH', 'CheXpert', 'cifar100', 'cifar10'):
+        if name in datadir:
+            return name
+    raise ValueError("Wrong data path!")
+
+def min_require_size(N, n_nets):
+    # every client needs 10 samples, unless there are too many clients for
+    # that to be likely, in which case the Dirichlet draw is not repeated
+    # (fill_empty_clients still gives every client a sample)
+    return min(10, N // (10 * n_nets))
+
+def fill_empty_clients(owner, n_nets, rng):
+    """
+    Give every client the draw left empty one sample, taken at random from
+    the client holding the most samples at that point. A draw without empty
+    clients is left as it is.
+
+    Args:
+        owner : (M,) client of every sample, modified in place
+    Returns:
+        [(position in owner, donor client, client)] of the moved samples
+    """
+    if len(owner) < n_nets:
+        raise ValueError('{} clients cannot all get a sample out of {}'.format(n_nets, len(owner)))
+    counts = np.bincount(owner, minlength=n_nets)
+    moves = []
+    for j in np.flatnonzero(counts == 0):
+        donor = counts.argmax()
+        pos = rng.choice(np.flatnonzero(owner == donor))
+        owner[pos] = j
+        counts[donor] -= 1
+        counts[j] += 1
+        moves.append((pos, donor, j))
+    if moves:
+        logging.info('{} clients were left empty by the Dirichlet draw and got one sample each'.format(len(moves)))
+    return moves
+
+def group_by_client(idx, owner, n_nets, rng):
+    """
+    Gather the samples of each client into one flat array.
+
+    Args:
+        idx : (M,) sample indices
+        owner : (M,) client of every sample
+    Returns:
+        indices : (M,) sample indices grouped by client, each client's
+                  samples shuffled once more
+        offsets : (n_nets + 1,) client j holds indices[offsets[j]:offsets[j+1]]
+    """
+    # a stable sort keeps the per-class order in which samples were dealt out
+    indices = idx[np.argsort(owner, kind='stable')]
+    offsets = np.zeros(n_nets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owner, minlength=n_nets), out=offsets[1:])
+    for j in range(n_nets):
+        rng.shuffle(indices[offsets[j]:offsets[j + 1]]) # shuffle once more
+    return indices, offsets
+
+def split_evenly(N, n_nets, rng):
+    # homo: a random permutation cut into n_nets nearly equal parts
+    if N < n_nets:
+        raise ValueError('{} clients cannot all get a sample out of {}'.format(n_nets, N))
+    idxs = rng.permutation(N)
+    sizes = np.array([len(b) for b in np.array_split(idxs, n_nets)])
+    return idxs, np.repeat(np.arange(n_nets), sizes)
+
+def split_counts(proportions, n):
+    # number of samples per client when n samples are cut at the cumulative proportions
+    bounds = (np.cumsum(proportions) * n).astype(int)[:-1]
+    return np.diff(np.concatenate(([0], bounds, [n])))
+
+def partition_xray(partition, n_nets, alpha, rng):
+    N = XRAY_TRAIN_NUM
+    if partition == "homo":
+        idxs, owner = split_evenly(N, n_nets, rng)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=n_nets))))
+        return {'indices': idxs, 'offsets': offsets}
+
+    idx_k = np.arange(N)
+    rng.shuffle(idx_k)
+    min_size = -1 # draw at least once
+    while min_size < min_require_size(N, n_nets):
+        proportions = rng.dirichlet(np.repeat(alpha, n_nets))
+        counts = split_counts(proportions / proportions.sum(), N)
+        min_size = counts.min()
+    owner = np.repeat(np.arange(n_nets), counts)
+    fill_empty_clients(owner, n_nets, rng)
+    indices, offsets = group_by_client(idx_k, owner, n_nets, rng)
+    return {'indices': indices, 'offsets': offsets}
+
+def partition_cifar(datadir, partition, n_nets, alpha, rng, imb_factor=0.1):
+    name = dataset_name(datadir)
+    _, y_train = load_cifar(datadir, train=True, download=True)
+    N = y_train.shape[0]
+    class_num = len(np.unique(y_train))
+    K = class_num
+    logging.info("N = " + str(N))
+    # samples of every class, in index order, as np.where(y_train == k) gives them
+    order = np.argsort(y_train, kind='stable')
+    class_offsets = np.concatenate(([0], np.cumsum(np.bincount(y_train, minlength=K))))
+
+    if partition == "homo":
+        indices, owner = split_evenly(N, n_nets, rng)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=n_nets))))
+        cls_counts = np.zeros((n_nets, K), dtype=np.int64)
+        np.add.at(cls_counts, (owner, y_train[indices]), 1)
+        client_pos_freq = cls_counts
+        client_neg_freq = np.bincount(y_train, minlength=K)[None, :] - cls_counts
+    else:
+        long_tail = None
+        if partition == "longtail":
+            long_tail = get_img_num_per_cls(name[len('cifar'):], imb_factor)
+        elif name == 'cifar100':
+            # hetero on CIFAR-100 has always used the 0.1 long tail
+            long_tail = get_img_num_per_cls('100')
+        if long_tail is not None:
+            print("Long Tail: ", long_tail)
+
+        min_size = -1 # draw at least once
+        while min_size < min_require_size(N, n_nets):
+            if name == 'cifar100' and partition == "hetero":
+                # unused draw, kept so that a seed gives the same partition as before
+                rng.dirichlet(np.repeat(alpha, n_nets))
+            idx, owner = [], []
+            class_freq = []
+            class_neg_freq = []
+            for k in range(K): # partition for the class k
+                idx_k = order[class_offsets[k]:class_offsets[k + 1]].copy()
+                rng.shuffle(idx_k)
+                if long_tail is not None:
+                    idx_k = idx_k[:long_tail[k]]
+                proportions = rng.dirichlet(np.repeat(alpha, n_nets))
+                proportions = proportions / proportions.sum()
+
+                class_freq.append((proportions * len(idx_k)).astype(int))
+                class_neg_freq.append(((1 - proportions) * len(idx_k)).astype(int))
+                idx.append(idx_k)
+                owner.append(np.repeat(np.arange(n_nets), split_counts(proportions, len(idx_k))))
+            idx, owner = np.concatenate(idx), np.concatenate(owner)
+            min_size = np.bincount(owner, minlength=n_nets).min()
+
+        client_pos_freq = np.array(class_freq).T
+        client_neg_freq = np.array(class_neg_freq).T
+        for pos, donor, j in fill_empty_clients(owner, n_nets, rng):
+            k = y_train[idx[pos]]
+            client_pos_freq[donor, k] = max(client_pos_freq[donor, k] - 1, 0)
+            client_pos_freq[j, k] += 1
+            client_neg_freq[donor, k] += 1
+            client_neg_freq[j, k] = max(client_neg_freq[j, k] - 1, 0)
+        indices, offsets = group_by_client(idx, owner, n_nets, rng)
+        cls_counts = np.zeros((n_nets, K), dtype=np.int64)
+        np.add.at(cls_counts, (owner, y_train[idx]), 1)
+
+    # Get clients' degree of data imbalances.
+    client_imbalances = imbalance_weights(client_pos_freq)
+
+    return {'indices': indices, 'offsets': offsets, 'class_num': np.array(class_num), 'cls_counts': cls_counts,
+            'client_pos_freq': client_pos_freq, 'client_neg_freq': client_neg_freq, 'client_imbalances': client_imbalances}
+
+def partition_path(datadir, partition, n_nets, alpha, seed, imb_factor=0.1):
+    name = 'partition_{}_{}_a{}_c{}_s{}'.format(dataset_name(datadir), partition, alpha, n_nets, seed)
+    if partition == "longtail":
+        name += '_ibf{}'.format(imb_factor)
+    return os.path.join(config.pkl_dir_path, name + '.npz')
+
+def load_partition(datadir, partition, n_nets, alpha, seed=None, imb_factor=0.1):
+    """
+    Partition artifact of a dataset: every client's sample indices as ranges
+    of one flat index array, plus (CIFAR) the per-client class counts,
+    positive/negative frequencies and imbalance weights. With a seed the
+    partition is drawn from its own RandomState and saved under
+    config.pkl_dir_path, keyed by (dataset, method, alpha, clients, seed).
+    Without one it is drawn from the global numpy state and not cached.
+    """
+    if partition not in ("homo", "hetero", "longtail"):
+        raise ValueError('partition method must be one of homo, hetero, longtail')
+    path = None
+    if seed is not None:
+        path = partition_path(datadir, partition, n_nets, alpha, seed, imb_factor)
+        if os.path.exists(path):
+            with np.load(path) as artifact:
+                artifact = {k: artifact[k] for k in artifact.files}
+            if np.diff(artifact['offsets']).min() > 0:
+                return artifact
+            # saved before every client was guaranteed a sample
+            logging.info('{} has empty clients; partitioning again'.format(path))
+
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    if dataset_name(datadir) in ('NIH', 'CheXpert'):
+        if partition == "longtail":
+            raise ValueError('longtail partitioning is only defined for CIFAR')
+        artifact = partition_xray(partition, n_nets, alpha, rng)
+    else:
+        artifact = partition_cifar(datadir, partition, n_nets, alpha, rng, imb_factor)
+
+    if path is not None:
+        if not os.path.exists(config.pkl_dir_path):
+            os.makedirs(config.pkl_dir_path, exist_ok=True)
+        tmp_path = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_path, **artifact)
+        os.replace(tmp_path, path)
+    return artifact
+
+def client_indices(artifact):
+    # {client: its sample indices}, views into the flat index array
+    indices, offsets = artifact['indices'], artifact['offsets']
+    return {j: indices[offsets[j]:offsets[j + 1]] for j in range(len(offsets) - 1)}
+
+def partition_data(datadir, partition, n_nets, alpha, seed=None, imb_factor=0.1):
+    logging.info("*********partition data***************")
+    artifact = load_partition(datadir, partition, n_nets, alpha, seed, imb_factor)
+    net_dataidx_map = client_indices(artifact)
+    if dataset_name(datadir) in ('NIH', 'CheXpert'):
+        return net_dataidx_map
+
+    traindata_cls_counts = record_net_data_stats(artifact['cls_counts'])
+    # the number of class, shuffled indices, record of it
+    return int(artifact['class_num']), net_dataidx_map, traindata_cls_counts, artifact['client_pos_freq'], \
+           artifact['client_neg_freq'], artifact['client_imbalances']
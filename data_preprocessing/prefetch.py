@@ -0,0 +1,114 @@
+'''
+Background prefetching of client batches
+'''
+import logging
+import queue
+import threading
+import time
+
+class BackgroundEpoch(object):
+    """
+    One epoch of `loader`, read by a daemon thread that keeps up to `depth`
+    batches ready (in pinned memory if `pin_memory`).
+    """
+    def __init__(self, loader, depth=2, pin_memory=False):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill, args=(loader, pin_memory), daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill(self, loader, pin_memory):
+        try:
+            for batch in loader:
+                if pin_memory:
+                    batch = [t.pin_memory() for t in batch]
+                if not self.put(batch):
+                    return
+        except Exception as e:
+            self.put(e)
+            return
+        self.put(None)
+
+    def close(self):
+        # stop the thread of an epoch that is not read to its end; it is
+        # joined so that it never overlaps the next epoch of the same loader
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+
+class PrefetchLoader(object):
+    """
+    Wraps the train DataLoader of a client so that batches are loaded in a
+    background thread while the model trains on the previous ones. warm()
+    starts the next epoch ahead of time, e.g. for the client a thread trains
+    next, so its first batches are ready when training starts.
+
+    Reading time is split into the time spent waiting for a batch (idle)
+    and the rest (busy), logged per epoch and summed in idle_seconds and
+    busy_seconds.
+    """
+    def __init__(self, loader, name, depth=2, pin_memory=False):
+        self.loader = loader
+        self.name = name
+        self.depth = depth
+        self.pin_memory = pin_memory
+        self.pending = None
+        self.idle_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def warm(self):
+        if self.pending is None:
+            self.pending = BackgroundEpoch(self.loader, self.depth, self.pin_memory)
+
+    def close(self):
+        # stop an epoch started by warm() that was never read, releasing its
+        # thread and buffered batches
+        if self.pending is not None:
+            self.pending.close()
+            self.pending = None
+
+    def __iter__(self):
+        epoch = self.pending if self.pending is not None else BackgroundEpoch(self.loader, self.depth, self.pin_memory)
+        self.pending = None
+        ready = epoch.queue.qsize()
+        batches = 0
+        idle = 0.0
+        start = time.time()
+        try:
+            while True:
+                wait = time.time()
+                batch = epoch.queue.get()
+                idle += time.time() - wait
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                batches += 1
+                yield batch
+        finally:
+            epoch.close()
+            total = time.time() - start
+            self.idle_seconds += idle
+            self.busy_seconds += total - idle
+            logging.info('{}: {} batches ({} ready at start), {:.2f}s of {:.2f}s idle waiting for data ({:.1%})'.format(
+                self.name, batches, ready, idle, total, idle / max(total, 1e-9)))
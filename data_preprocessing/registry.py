@@ -0,0 +1,146 @@
+'''
+Lazily built DataLoaders
+'''
+from collections import OrderedDict
+
+class ClientRegistry(object):
+    """
+    Drop-in for the {client_idx: DataLoader} dicts handed to the clients.
+    The loader of a client is built by `build(client_idx)` the first time it
+    is looked up in a process and kept afterwards, so a worker only ever
+    builds the loaders of the clients it trains. Pickling a registry (e.g.
+    into a pool worker) sends only `build`, never the loaders.
+
+    Args:
+        num_clients : clients are 0 .. num_clients - 1
+        build : picklable callable, client_idx -> DataLoader
+    """
+    def __init__(self, num_clients, build):
+        self.num_clients = num_clients
+        self.build = build
+        self.loaders = {}
+
+    def __getitem__(self, client_idx):
+        loader = self.loaders.get(client_idx)
+        if loader is None:
+            if not 0 <= client_idx < self.num_clients:
+                raise KeyError(client_idx)
+            loader = self.build(client_idx)
+            self.loaders[client_idx] = loader
+        return loader
+
+    def __contains__(self, client_idx):
+        return 0 <= client_idx < self.num_clients
+
+    def __len__(self):
+        return self.num_clients
+
+    def __iter__(self):
+        return iter(range(self.num_clients))
+
+    def keys(self):
+        return range(self.num_clients)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['loaders'] = {}
+        return state
+
+class LazyLoader(object):
+    """
+    Stands in for a DataLoader that is only built, by `build()`, when it is
+    first iterated or one of its attributes is used, e.g. the global loaders
+    the server keeps but may never read. len() does not build it when the
+    length is given. Pickling sends only `build`.
+
+    Args:
+        build : picklable callable returning the DataLoader
+        length : number of batches of the loader, if known without building it
+    """
+    def __init__(self, build, length=None):
+        self.build = build
+        self.length = length
+        self._loader = None
+
+    @property
+    def loader(self):
+        if self._loader is None:
+            self._loader = self.build()
+        return self._loader
+
+    def __len__(self):
+        return self.length if self.length is not None else len(self.loader)
+
+    def __iter__(self):
+        return iter(self.loader)
+
+    def __getattr__(self, name):
+        # only called for attributes the proxy lacks, e.g. dataset or batch_size
+        if name.startswith('__') or name == '_loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_loader'] = None
+        return state
+
+def start_workers(loader):
+    # start the worker processes of a loader with persistent workers now,
+    # as its first iter() would; they then survive between epochs
+    loader = getattr(loader, 'loader', loader) # a PrefetchLoader's DataLoader
+    if getattr(loader, 'persistent_workers', False) and loader.num_workers > 0 and loader._iterator is None:
+        loader._iterator = loader._get_iterator()
+
+def shutdown_workers(loader):
+    # DataLoader has no public way to stop persistent workers; the next
+    # iter() of the loader starts new ones
+    loader = getattr(loader, 'loader', loader)
+    if getattr(loader, '_iterator', None) is not None:
+        loader._iterator._shutdown_workers()
+        loader._iterator = None
+
+class LoaderPool(object):
+    """
+    Bounds the number of clients whose DataLoader workers are kept alive in
+    a process. Loaders with persistent workers keep num_workers processes
+    running after an epoch; over many clients a process would otherwise
+    accumulate them for every client it has trained. The workers of the
+    least recently used client are shut down once more than `capacity`
+    clients are live, unless a live client shares that loader.
+
+    Args:
+        capacity : number of clients whose loaders stay live; with 2 or more,
+                   the next scheduled client can be warmed up while the
+                   current one trains
+    """
+    def __init__(self, capacity=2):
+        self.capacity = max(1, capacity)
+        self.live = OrderedDict()
+
+    def use(self, client_idx, *loaders):
+        # mark the loaders of client_idx as the most recently used ones
+        self.live[client_idx] = loaders
+        self.live.move_to_end(client_idx)
+        while len(self.live) > self.capacity:
+            _, evicted = self.live.popitem(last=False)
+            in_use = {id(loader) for live in self.live.values() for loader in live}
+            for loader in evicted:
+                if id(loader) not in in_use:
+                    shutdown_workers(loader)
+        return loaders
+
+    def warm(self, client_idx, *loaders):
+        # start the workers of the client trained next, so that they come
+        # up while the current client trains
+        if self.capacity < 2 or client_idx in self.live:
+            return
+        for loader in loaders:
+            start_workers(loader)
+        self.use(client_idx, *loaders)
+
+    def close(self):
+        for loaders in self.live.values():
+            for loader in loaders:
+                shutdown_workers(loader)
+        self.live.clear()
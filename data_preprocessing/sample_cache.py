@@ -0,0 +1,197 @@
+'''
+In-memory cache of decoded and resized samples, shared by the clients of a process
+'''
+import logging
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+# modes whose pixels round-trip through a uint8 array
+CACHED_MODES = ('L', 'RGB', 'RGBA')
+
+def split_transform(transform):
+    """
+    Split a transform into its deterministic decode/resize steps and the
+    rest: the leading Resize, CenterCrop and decode steps (those marked
+    `cacheable`, e.g. ReducedDecode) up to the last resize among them.
+
+    Returns:
+        prefix, rest : Composes, prefix is None if nothing can be cached
+    """
+    steps = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    cut = 0
+    for i, t in enumerate(steps):
+        if isinstance(t, (transforms.Resize, transforms.CenterCrop)):
+            cut = i + 1
+        elif not getattr(t, 'cacheable', False):
+            break
+    if cut == 0:
+        return None, transform
+    return transforms.Compose(steps[:cut]), transforms.Compose(steps[cut:])
+
+def encoded_size(img):
+    # size of the file (or bytes) a lazily opened PIL image is read from
+    fp = getattr(img, 'fp', None)
+    try:
+        return os.fstat(fp.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        return fp.getbuffer().nbytes
+    except (AttributeError, ValueError):
+        return 0
+
+class SampleCache(object):
+    """
+    Keeps the images of a process's client datasets decoded and resized,
+    as uint8 arrays, so a client revisited in a later round (or another
+    client sharing its images) skips reading and decoding them. Only the
+    deterministic front of a transform is cached (see split_transform); the
+    rest, e.g. ToTensor and Normalize, runs on every access, so a cached
+    sample comes out as an uncached one would. Transforms that start with a
+    random step are not cached.
+
+    The cache lives in the process that calls the datasets: a pool worker
+    for loaders without workers, or each worker of a DataLoader with
+    workers. Use get_sample_cache() to get the cache of the current process.
+
+    Args:
+        budget : bytes of image data kept
+        policy : 'lru' evicts the least recently used image; 'lfu' the least
+                 frequently used one, the least recently used among equals
+    """
+    def __init__(self, budget, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('sample cache policy must be lru or lfu')
+        self.budget = budget
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.entries = {} # key -> (array, encoded size, uses)
+        self.order = OrderedDict() # lru: key -> None, least recently used first
+        self.buckets = {} # lfu: uses -> OrderedDict of keys, least recently used first
+        self.nbytes = 0
+        self.splits = {} # id(transform) -> (transform, prefix, rest)
+        self.totals = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}
+        self.round = dict(self.totals)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def split(self, transform):
+        if id(transform) not in self.splits:
+            # keeps a reference, so the id is not reused
+            self.splits[id(transform)] = (transform,) + split_transform(transform)
+        return self.splits[id(transform)][1:]
+
+    def count(self, name, n=1):
+        self.totals[name] += n
+        self.round[name] += n
+
+    def touch(self, key):
+        array, size, uses = self.entries[key]
+        if self.policy == 'lru':
+            self.order.move_to_end(key)
+        else:
+            del self.buckets[uses][key]
+            if not self.buckets[uses]:
+                del self.buckets[uses]
+            self.buckets.setdefault(uses + 1, OrderedDict())[key] = None
+        self.entries[key] = (array, size, uses + 1)
+        return array, size
+
+    def evict(self):
+        if self.policy == 'lru':
+            key, _ = self.order.popitem(last=False)
+        else:
+            uses = min(self.buckets)
+            key, _ = self.buckets[uses].popitem(last=False)
+            if not self.buckets[uses]:
+                del self.buckets[uses]
+        self.nbytes -= self.entries.pop(key)[0].nbytes
+        self.count('evictions')
+
+    def insert(self, key, array, size):
+        if key in self.entries or array.nbytes > self.budget:
+            return
+        while self.nbytes + array.nbytes > self.budget:
+            self.evict()
+        self.entries[key] = (array, size, 1)
+        if self.policy == 'lru':
+            self.order[key] = None
+        else:
+            self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.nbytes += array.nbytes
+
+    def load(self, key, open_image, transform, size=None):
+        """
+        transform(open_image()), reading the decoded and resized image from
+        the cache when it holds `key`.
+
+        Args:
+            key : identifies the image, e.g. its path
+            open_image : returns the lazily opened PIL image
+            size : returns the encoded size of the image, for images that
+                   open_image has already decoded
+        """
+        if transform is None:
+            return open_image()
+        prefix, rest = self.split(transform)
+        if prefix is None:
+            return transform(open_image())
+        key = (id(prefix), key)
+        with self.lock:
+            hit = self.touch(key) if key in self.entries else None
+            if hit is not None:
+                self.count('hits')
+                self.count('bytes_saved', hit[1])
+        if hit is not None:
+            return rest(Image.fromarray(hit[0]))
+        img = open_image()
+        nbytes = encoded_size(img) if size is None else size()
+        img = prefix(img)
+        with self.lock:
+            self.count('misses')
+            if img.mode in CACHED_MODES:
+                self.insert(key, np.array(img), nbytes)
+        return rest(img)
+
+    def end_round(self):
+        """
+        Statistics of the round that ends, which are then reset.
+
+        Returns:
+            dict of hits, misses, hit_rate, bytes_saved (encoded bytes not
+            read again), evictions, entries and bytes held
+        """
+        with self.lock:
+            stats = dict(self.round)
+            self.round = {k: 0 for k in self.round}
+            stats['hit_rate'] = stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.nbytes
+        return stats
+
+    def __reduce__(self):
+        # unpickled as the cache of the receiving process
+        return get_sample_cache, (self.budget, self.policy)
+
+_cache = None
+
+def get_sample_cache(budget, policy='lru'):
+    # the cache of this process, created on first use
+    global _cache
+    if _cache is None or (_cache.budget, _cache.policy) != (budget, policy):
+        _cache = SampleCache(budget, policy)
+    return _cache
+
+def log_round(name, round_idx):
+    # log this round's statistics of the process's cache, if it has one
+    if _cache is None:
+        return
+    stats = _cache.end_round()
+    logging.info('{} round {}: sample cache {:.1%} hits ({} of {}), {:.1f} MB not read again, {} evictions, {} images in {:.1f} of {:.1f} MB'.format(
+        name, round_idx, stats['hit_rate'], stats['hits'], stats['hits'] + stats['misses'], stats['bytes_saved'] / 2**20,
+        stats['evictions'], stats['entries'], stats['bytes'] / 2**20, _cache.budget / 2**20))
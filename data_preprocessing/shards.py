@@ -0,0 +1,251 @@
+'''
+Sharded image storage: tar shards with an offset index
+
+    python -m data_preprocessing.shards --data_dir data/NIH [--shard_mb 256]
+        [--partition_method hetero --partition_alpha 0.5 --client_number 40 --partition_seed 1]
+
+packs the images of every split of a dataset into
+{data_dir}/shards/{split}/shard-NNNNN.tar. index.npz maps every sample, by
+its index in the dataset, to its shard and the byte range of its file in
+it, so the sample indices of a partition (dataidxs, indices) address packed
+samples directly and a reader fetches an image with one pread() instead of
+opening one small file per image. Shards are plain tar files.
+
+Given the partition main.py trains with (same method, alpha, clients and
+partition seed), the train split is packed one client after another, so a
+client's epoch reads a few shards front to back instead of seeking across
+all of them. Without one, or for another partition, samples are in dataset
+order: the shards still serve every partition, with less locality.
+'''
+import argparse
+import io
+import logging
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from data_preprocessing import config
+
+SHARD_NAME = 'shard-{:05d}.tar'
+SHARD_INDEX = 'index.npz'
+
+def shard_dir(data_dir, split):
+    return os.path.join(data_dir, config.shards_dir, split)
+
+def has_shards(out_dir):
+    # the index is written last, so a pack that did not finish has none
+    return os.path.exists(os.path.join(out_dir, SHARD_INDEX))
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def partition_order(n, artifact):
+    """
+    Packing order of n samples that keeps every client's samples together:
+    the clients' indices one client after another, then the samples no
+    client holds.
+
+    Args:
+        artifact : partition.load_partition artifact
+    """
+    indices = artifact['indices']
+    return np.concatenate((indices, np.setdiff1d(np.arange(n), indices)))
+
+def pack_shards(paths, targets, out_dir, shard_bytes=256 << 20, threads=8, chunk=1024, order=None):
+    """
+    Pack the files `paths` into tar shards of about shard_bytes each;
+    sample i of the shards is paths[i], wherever `order` puts it. Files
+    are read by `threads` threads, `chunk` at a time, and written in order.
+
+    Args:
+        paths : image files
+        targets : (N, ...) labels of the images, saved in the index
+        out_dir : directory of the shards and their index
+        order : permutation of range(N) the samples are written in, e.g.
+                partition_order; dataset order if None
+
+    Returns:
+        number of shards written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    index_path = os.path.join(out_dir, SHARD_INDEX)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    n = len(paths)
+    order = np.arange(n) if order is None else np.asarray(order)
+    if len(order) != n or not np.array_equal(np.sort(order), np.arange(n)):
+        raise ValueError('order must be a permutation of the {} samples'.format(n))
+    shard = np.zeros(n, dtype=np.int32)
+    offset = np.zeros(n, dtype=np.int64)
+    size = np.zeros(n, dtype=np.int64)
+    tar = None
+    num_shards = 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for start in range(0, n, chunk):
+            ids = order[start:start + chunk]
+            for i, data in zip(ids, pool.map(_read_file, [paths[j] for j in ids])):
+                if tar is None or tar.offset >= shard_bytes:
+                    if tar is not None:
+                        tar.close()
+                    tar = tarfile.open(os.path.join(out_dir, SHARD_NAME.format(num_shards)), 'w')
+                    num_shards += 1
+                info = tarfile.TarInfo('{:09d}{}'.format(i, os.path.splitext(str(paths[i]))[1].lower()))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                # the member's data (padded to whole blocks) ends the archive so far
+                shard[i] = num_shards - 1
+                size[i] = len(data)
+                offset[i] = tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    if tar is not None:
+        tar.close()
+    tmp_path = index_path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+    np.savez(tmp_path, shard=shard, offset=offset, size=size, targets=np.asarray(targets),
+             paths=np.array([str(p).encode() for p in paths], dtype=bytes), num_shards=np.array(num_shards))
+    os.replace(tmp_path, index_path)
+    return num_shards
+
+class ShardReader(object):
+    """
+    Random access to the samples written by pack_shards. Shard files are
+    opened on first use in every process (and DataLoader worker); pickling
+    a reader sends its index, not its open files.
+
+    Attributes:
+        shard, offset, size : (N,) location of every sample
+        targets : labels saved with the shards
+    """
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        with np.load(os.path.join(out_dir, SHARD_INDEX)) as index:
+            self.shard = index['shard']
+            self.offset = index['offset']
+            self.size = index['size']
+            self.targets = index['targets']
+            self.paths = index['paths']
+            self.num_shards = int(index['num_shards'])
+        self.files = {}
+
+    def __len__(self):
+        return len(self.shard)
+
+    def read(self, i):
+        # the encoded bytes of sample i
+        s = int(self.shard[i])
+        fd = self.files.get(s)
+        if fd is None:
+            fd = os.open(os.path.join(self.out_dir, SHARD_NAME.format(s)), os.O_RDONLY)
+            self.files[s] = fd
+        return os.pread(fd, int(self.size[i]), int(self.offset[i]))
+
+    def image(self, i):
+        # opened lazily as Image.open(path) is, so reduced decoding still applies
+        return Image.open(io.BytesIO(self.read(i)))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['files'] = {}
+        return state
+
+# shard directory -> ShardReader opened in this process
+_readers = {}
+
+def open_shards(out_dir):
+    # one reader per process, shared by the datasets of all its clients
+    out_dir = os.path.abspath(out_dir)
+    if out_dir not in _readers:
+        _readers[out_dir] = ShardReader(out_dir)
+    return _readers[out_dir]
+
+class ShardShuffleSampler(torch.utils.data.Sampler):
+    """
+    Shuffles a sharded dataset one shard at a time: shards are visited in
+    random order and the samples of a shard in random order, so an epoch
+    reads through each shard once instead of seeking across all of them.
+
+    Args:
+        shard_ids : (n,) shard of every sample of the dataset, e.g.
+                    ShardReader.shard[dataidxs] for a client
+    """
+    def __init__(self, shard_ids):
+        self.shard_ids = np.asarray(shard_ids)
+
+    def __len__(self):
+        return len(self.shard_ids)
+
+    def __iter__(self):
+        n = len(self.shard_ids)
+        if n == 0:
+            return iter([])
+        perm = torch.randperm(n).numpy()
+        shard_rank = torch.randperm(int(self.shard_ids.max()) + 1).numpy()
+        # a stable sort by the shards' random ranks keeps the shuffled order within a shard
+        order = perm[np.argsort(shard_rank[self.shard_ids[perm]], kind='stable')]
+        return iter(order.tolist())
+
+def shard_sampler(dataset):
+    # the sampler of a shuffled loader over `dataset`; None if it is not sharded
+    shard_ids = getattr(dataset, 'shard_ids', None)
+    return None if shard_ids is None else ShardShuffleSampler(shard_ids)
+
+def dataset_splits(data_dir):
+    """
+    The images of every split of a dataset, in the order its datasets list them.
+
+    Returns:
+        {split: (paths, targets)}
+    """
+    from data_preprocessing.datasets import load_image_folder
+    from data_preprocessing.metadata import CHEXPERT_TEST_CSV, CHEXPERT_TRAIN_CSV, NIHMetadata, ChexpertMetadata
+    from data_preprocessing.partition import dataset_name
+    try:
+        name = dataset_name(data_dir)
+    except ValueError: # not an X-ray or CIFAR root
+        name = None
+    if name == 'NIH':
+        metadata = NIHMetadata(data_dir)
+        return {'train': (metadata.train_val_paths, metadata.train_val_labels),
+                'test': (metadata.test_paths, metadata.test_labels)}
+    if name == 'CheXpert':
+        train, test = ChexpertMetadata(CHEXPERT_TRAIN_CSV), ChexpertMetadata(CHEXPERT_TEST_CSV)
+        return {'train': (train.paths, train.labels), 'test': (test.paths, test.labels)}
+    if name is not None:
+        raise ValueError('CIFAR splits are loaded into memory whole; there is nothing to pack')
+    splits = {}
+    for split in ('train', 'val'):
+        folder, paths, targets = load_image_folder(data_dir, split)
+        splits[split] = ([os.path.join(folder, p.decode()) for p in paths], targets)
+    return splits
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data/NIH',
+            help='dataset root: NIH, CheXpert or an image folder with train and val folders')
+    parser.add_argument('--shard_mb', type=int, default=256,
+            help='size of a shard in MB')
+    parser.add_argument('--threads', type=int, default=8,
+            help='number of threads reading images')
+    parser.add_argument('--partition_method', type=str, default=None,
+            help='pack the X-ray train split one client after another for this partition (homo, hetero), as main.py draws it')
+    parser.add_argument('--partition_alpha', type=float, default=1,
+            help='alpha of the partition, as in main.py')
+    parser.add_argument('--client_number', type=int, default=5,
+            help='number of clients of the partition, as in main.py')
+    parser.add_argument('--partition_seed', type=int, default=1,
+            help='seed of the partition, as in main.py')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for split, (paths, targets) in dataset_splits(args.data_dir).items():
+        start = time.time()
+        out_dir = shard_dir(args.data_dir, split)
+        order = None
+        if args.partition_method is not None and split == 'train':
+            from data_preprocessing.partition import load_partition
+            artifact = load_partition(args.data_dir, args.partition_method, args.client_number, args.partition_alpha, args.partition_seed)
+            order = partition_order(len(paths), artifact)
+        num_shards = pack_shards(paths, targets, out_dir, args.shard_mb << 20, args.threads, order=order)
+        print('{}: {} images in {} shards under {} ({:.1f}s)'.format(split, len(paths), num_shards, out_dir, time.time() - start))
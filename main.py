@@ -14,6 +14,7 @@ from torch.multiprocessing import set_start_method, Queue
 import logging
 import os
 from collections import defaultdict
+from functools import partial
 import time
 
 # methods
@@ -22,7 +23,9 @@ import methods.fedprox as fedprox
 import methods.moon as moon
 import methods.fedalign as fedalign
 import methods.fedbb as fedbb
+from methods.losses import build_weight_tables
 import data_preprocessing.custom_multiprocess as cm
+from data_preprocessing.batch_service import BatchService
 
 def add_args(parser):
     # Training settings
@@ -42,11 +45,14 @@ def add_args(parser):
                         help='data directory: cifar100, cifar10, NIH, CheXpert')
 
     parser.add_argument('--partition_method', type=str, default='hetero', metavar='N',
-                        help='how to partition the dataset on local clients')
+                        help='how to partition the dataset on local clients: homo, hetero, longtail (CIFAR, uses --ibf)')
 
     parser.add_argument('--partition_alpha', type=float, default= 1, metavar='PA',
                         help='alpha value for Dirichlet distribution partitioning of data(default: 0.5)')
 
+    parser.add_argument('--partition_seed', type=int, default=1, metavar='S',
+                        help='seed of the client partition; partitions are cached per seed under pickles/')
+
     parser.add_argument('--client_number', type=int, default=5, metavar='NN',
                         help='number of clients in the FL system')
 
@@ -85,6 +91,42 @@ def add_args(parser):
     parser.add_argument('--num_subnets', type=int, default=3,
                         help='how many subnets sampled during training')
 
+    parser.add_argument('--bn_recalib_every', type=int, default=1, metavar='K',
+                        help='recalibrate BN statistics before client evaluation every K rounds (fedalign)')
+
+    parser.add_argument('--bn_recalib_batches', type=int, default=8, metavar='N',
+                        help='number of extra training batches used for BN recalibration (fedalign)')
+
+    parser.add_argument('--bn_cache_batches', type=int, default=0, metavar='N',
+                        help='keep the BN recalibration batches of the N most recently evaluated clients of each thread in memory across rounds; 0 disables (fedalign)')
+
+    parser.add_argument('--image_cache', action='store_true', default=False,
+                        help='NIH/CheXpert: decode and resize all images once into a memory-mapped store')
+
+    parser.add_argument('--reduced_decode', type=float, default=2.0, metavar='GAP',
+                        help='NIH/CheXpert: decode images at reduced resolution, keeping at least GAP times the 150px input size; 0 decodes at full resolution')
+
+    parser.add_argument('--gray_input', action='store_true', default=False,
+                        help='CheXpert: feed single-channel images to a 1-channel ResNet stem instead of replicating them to 3 channels')
+
+    parser.add_argument('--batch_augment', action='store_true', default=False,
+                        help='CIFAR: crop, flip and normalize whole uint8 batches as tensors instead of per-sample PIL transforms')
+
+    parser.add_argument('--live_loaders', type=int, default=2, metavar='N',
+                        help='number of clients per thread whose DataLoader workers are kept alive; the next scheduled client is warmed up when this is 2 or more')
+
+    parser.add_argument('--batch_service', type=int, default=0, metavar='N',
+                        help='decode and augment the training batches of all threads in N shared worker processes; 0 lets every thread load its own')
+
+    parser.add_argument('--prefetch_batches', type=int, default=0, metavar='N',
+                        help='load training batches in a background thread, keeping N ready; the next scheduled client is started ahead of time. 0 disables')
+
+    parser.add_argument('--sample_cache_mb', type=int, default=0, metavar='MB',
+                        help='NIH/CheXpert: keep up to MB of decoded and resized images in memory per process, shared by all its clients; 0 disables')
+
+    parser.add_argument('--sample_cache_policy', type=str, default='lru', choices=['lru', 'lfu'],
+                        help='images the sample cache evicts first: least recently (lru) or least frequently (lfu) used')
+
     parser.add_argument('--save_client', action='store_true', default=False,
                         help='Save client checkpoints each round')
 
@@ -119,7 +161,7 @@ def set_random_seed(seed=1):
     # torch.backends.cudnn.benchmark = False
 
 # Helper Functions
-def init_process(q, Client):
+def init_process(q, Client, batch_service=None, ready=None):
     # q is the client info
     set_random_seed()
     global client # 새롭게 클라이언트를 전역으로 선언
@@ -127,6 +169,11 @@ def init_process(q, Client):
     # c1 is the namespace
     ci = q.get() # Queued에서 맨 앞의 원소를 하나 가져오고 remove
     client = Client(ci[0], ci[1]) 
+    if batch_service is not None:
+        client.batch_lane = batch_service.claim_lane()
+    if ready is not None:
+        # tell the main process this thread's client is set up
+        ready.put(os.getpid())
 
 def run_clients(received_info):
     try:
@@ -162,11 +209,19 @@ if __name__ == "__main__":
     # get arguments
     parser = argparse.ArgumentParser()
     args = add_args(parser)
+    if args.gray_input and 'CheXpert' not in args.data_dir:
+        raise ValueError('--gray_input is only supported for CheXpert')
  
     ###################################### get data
     train_data_num, test_data_num, train_data_global, test_data_global, data_local_num_dict, train_data_local_dict, test_data_local_dict,\
-         class_num, client_pos_freq, client_neg_freq, client_imbalances = dl.load_partition_data(args.data_dir, args.partition_method, args.partition_alpha, args.client_number, args.batch_size)
+         class_num, client_pos_freq, client_neg_freq, client_imbalances = dl.load_partition_data(args.data_dir, args.partition_method, args.partition_alpha, args.client_number, args.batch_size,
+                                                             image_cache=args.image_cache, reduced_decode=args.reduced_decode,
+                                                             gray_input=args.gray_input, batch_augment=args.batch_augment,
+                                                             seed=args.partition_seed, imb_factor=args.ibf,
+                                                             sample_cache=(args.sample_cache_mb << 20, args.sample_cache_policy) if args.sample_cache_mb > 0 else None)
     print(client_imbalances)
+    # class-balanced loss weights, computed once and loaded by every worker
+    loss_tables = build_weight_tables(client_pos_freq, client_neg_freq)
     
     # train_data_num = 50000
     # test_data_num = 312
@@ -193,7 +248,7 @@ if __name__ == "__main__":
         server_dict = {'train_data':train_data_global, 'test_data': test_data_global, 'model_type': Model, 'num_classes': class_num, 'dir': args.data_dir, 'harmony': args.harmony, 'imbalances': client_imbalances}
         client_dict = [{'train_data':train_data_local_dict, 'test_data': test_data_local_dict, 'device': i % torch.cuda.device_count(),
                             'client_map':mapping_dict[i], 'model_type': Model, 'num_classes': class_num, 'dir': args.data_dir, 'harmony': args.harmony,
-                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq} for i in range(args.thread_number)]
+                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq, 'loss_tables': loss_tables} for i in range(args.thread_number)]
     elif args.method=='moon':
         Server = moon.Server
         Client = moon.Client
@@ -201,7 +256,7 @@ if __name__ == "__main__":
         server_dict = {'train_data':train_data_global, 'test_data': test_data_global, 'model_type': Model, 'num_classes': class_num, 'dir': args.data_dir, 'harmony': args.harmony,'imbalances': client_imbalances}
         client_dict = [{'train_data':train_data_local_dict, 'test_data': test_data_local_dict, 'device': i % torch.cuda.device_count(),
                             'client_map':mapping_dict[i], 'model_type': Model, 'num_classes': class_num, 'dir': args.data_dir, 'harmony': args.harmony,
-                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq} for i in range(args.thread_number)]
+                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq, 'loss_tables': loss_tables} for i in range(args.thread_number)]
     elif args.method=='fedalign':
         Server = fedalign.Server
         Client = fedalign.Client
@@ -212,7 +267,7 @@ if __name__ == "__main__":
         client_dict = [{'train_data':train_data_local_dict, 'test_data': test_data_local_dict, 'device': i % torch.cuda.device_count(),
                             'client_map':mapping_dict[i], 'model_type': Model, 'num_classes': class_num, 
                             'width_range': width_range, 'resolutions': resolutions, 'dir': args.data_dir, 'harmony': args.harmony,
-                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq} for i in range(args.thread_number)]
+                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq, 'loss_tables': loss_tables} for i in range(args.thread_number)]
     elif args.method=='fedbb':
         Server = fedbb.Server
         Client = fedbb.Client
@@ -223,9 +278,15 @@ if __name__ == "__main__":
         client_dict = [{'train_data':train_data_local_dict, 'test_data': test_data_local_dict, 'device': i % torch.cuda.device_count(),
                             'client_map':mapping_dict[i], 'model_type': Model, 'num_classes': class_num, 
                             'width_range': width_range, 'resolutions': resolutions, 'dir': args.data_dir,
-                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq} for i in range(args.thread_number)]
+                            'clients_pos': client_pos_freq, 'clients_neg': client_neg_freq, 'loss_tables': loss_tables} for i in range(args.thread_number)]
     else:
         raise ValueError('Invalid --method chosen! Please choose from availible methods.')
+    if args.gray_input:
+        # single-channel CheXpert input needs a 1-channel stem
+        Model = partial(Model, in_channels=1)
+        server_dict['model_type'] = Model
+        for c_dict in client_dict:
+            c_dict['model_type'] = Model
     
     #init nodes
     client_info = Queue()
@@ -235,7 +296,12 @@ if __name__ == "__main__":
 
     ######################################################
     # Start server and get initial outputs
-    pool = cm.MyPool(args.thread_number, init_process, (client_info, Client)) 
+    batch_service = None
+    if args.batch_service > 0:
+        # one decode/augment pool for the training batches of every thread
+        batch_service = BatchService(train_data_local_dict.build, args.client_number, num_workers=args.batch_service, lanes=args.thread_number)
+    ready = Queue()
+    pool = cm.MyPool(args.thread_number, init_process, (client_info, Client, batch_service, ready)) 
     # thread의 갯수 만큼 init_process 실행(일종의 멀티 프로세스 초기화 함수)
     # args.thread_number : 현재 시스템에서 사용할 프로세스의 갯수
     # thread 갯수 만큼의 client_dict와 client객체 하나를 인수로 넘겨줌 
@@ -250,7 +316,12 @@ if __name__ == "__main__":
     # weight of the server
     # Start Federated Training
     # the length is the number of treads
-    time.sleep(150*(args.client_number/16)) #  Allow time for threads to start up
+    # wait until every thread has set up its client, so that each takes one
+    # thread's share of the first round
+    start = time.time()
+    for _ in range(args.thread_number):
+        ready.get()
+    logging.info('{} threads ready in {:.1f}s'.format(args.thread_number, time.time() - start))
     for r in range(args.comm_round):
         logging.info('***** Round: {} ************************'.format(r))
         round_start = time.time()
@@ -268,3 +339,5 @@ if __name__ == "__main__":
         logging.info('Round {} Time: {:.0f}m {:.0f}s'.format(r, total_min, total_sec % 60))
     pool.close()
     pool.join()
+    if batch_service is not None:
+        batch_service.close()
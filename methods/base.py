@@ -4,15 +4,61 @@ import json
 from torch.multiprocessing import current_process
 import numpy as np
 import os
-from sklearn.metrics import roc_auc_score,  roc_curve
+from collections import OrderedDict
 from datetime import datetime
 import os
+from data_preprocessing.registry import LoaderPool
+from data_preprocessing.prefetch import PrefetchLoader
+from data_preprocessing.sample_cache import log_round
 
 global result_dir 
 now = datetime.now()
 result_dir = os.getcwd() + "/Results/{}_{}H".format(now.date(), str(now.hour))
 model_dir = result_dir + "/models"
 
+def num_train_samples(loader, batch_size):
+    # samples a client trains on per epoch: its whole batches, or all of
+    # them when it has less than a batch and its loader keeps the partial one
+    n = len(loader.dataset)
+    return n if n < batch_size else len(loader)*batch_size
+
+def trained_clients(client_info):
+    """
+    The results of the clients that trained on at least one sample, sorted
+    by client index. A client without training samples returns the model it
+    received; it gets no aggregation weight, and the sample weights of the
+    others do not divide by zero when no client of a round trained.
+    """
+    client_info.sort(key=lambda tup: tup['client_index'])
+    trained = [c for c in client_info if c['num_samples'] > 0]
+    if len(trained) < len(client_info):
+        logging.info('{} of {} clients had no training samples and are not aggregated'.format(len(client_info) - len(trained), len(client_info)))
+    return trained
+
+def harmony_weights(imbalance_weights, client_info, gamma):
+    """
+    Aggregation weights of the harmony option: gamma * the imbalance weights
+    of the aggregated clients, renormalized over them, plus (1 - gamma) *
+    their shares of the samples. When only some clients are aggregated
+    (client sampling, clients without samples) the imbalance weights of the
+    rest would otherwise be missing and shrink the model toward zero.
+
+    Returns:
+        (len(client_info),) weights summing to 1
+    """
+    cw1 = np.asarray(imbalance_weights, dtype=np.float64)[[c['client_index'] for c in client_info]]
+    cw2 = np.array([c['num_samples'] for c in client_info], dtype=np.float64)
+    cw2 = cw2 / cw2.sum()
+    if cw1.sum() > 0:
+        cw1 = cw1 / cw1.sum()
+    else:
+        # no aggregated client has a defined imbalance; use the sample shares
+        cw1 = cw2
+    cw = gamma * cw1 + (1 - gamma) * cw2
+    if not np.isclose(cw.sum(), 1.0):
+        raise ValueError('aggregation weights sum to {}, not 1'.format(cw.sum()))
+    return cw
+
 class Base_Client():
     def __init__(self, client_dict, args):
         self.train_data = client_dict['train_data'] # dataloader(with all clients)
@@ -27,7 +73,57 @@ class Base_Client():
         self.train_dataloader = None
         self.test_dataloader = None
         self.client_index = None
+        # loaders whose worker processes are kept alive in this thread
+        self.loader_pool = LoaderPool(args.live_loaders)
+        # lane of the node's BatchService, if training batches are decoded there
+        self.batch_lane = None
+        # prefetching wrappers of the most recently selected clients, least
+        # recently used first; as many are kept as the loader pool keeps live
+        # clients, and at least the current and the next one
+        self.prefetch_loaders = OrderedDict()
+
+    def next_client(self, position):
+        # the client this thread trains after the one at `position` of this round
+        clients = self.client_map[self.round]
+        if position + 1 < len(clients):
+            return clients[position + 1]
+        if self.round + 1 < len(self.client_map):
+            return self.client_map[self.round + 1][0]
+        return None
+
+    def client_loaders(self, client_idx):
+        train_loader = self.train_data[client_idx]
+        if self.batch_lane is not None:
+            # the service already builds batches ahead of training
+            train_loader = self.batch_lane.loader(client_idx, train_loader)
+        elif self.args.prefetch_batches > 0:
+            if client_idx not in self.prefetch_loaders:
+                self.prefetch_loaders[client_idx] = PrefetchLoader(train_loader, 'client {}'.format(client_idx), self.args.prefetch_batches,
+                                                                   pin_memory=torch.cuda.is_available())
+            self.prefetch_loaders.move_to_end(client_idx)
+            train_loader = self.prefetch_loaders[client_idx]
+            while len(self.prefetch_loaders) > max(self.loader_pool.capacity, 2):
+                _, evicted = self.prefetch_loaders.popitem(last=False)
+                evicted.close()
+        return train_loader, self.test_data[client_idx]
+
+    def select_client(self, position, client_idx):
+        # point train/test_dataloader at the client at `position` of this
+        # round and warm up the client trained after it
+        self.train_dataloader, self.test_dataloader = self.loader_pool.use(client_idx, *self.client_loaders(client_idx))
+        self.client_index = client_idx
+        next_idx = self.next_client(position)
+        if next_idx is not None:
+            next_train, next_test = self.client_loaders(next_idx)
+            self.loader_pool.warm(next_idx, next_train, next_test)
+            if isinstance(next_train, PrefetchLoader):
+                next_train.warm()
     
+    def end_round(self):
+        # log the round's hits of this process's sample cache, if it has one
+        log_round(current_process().name, self.round)
+        self.round += 1
+
     def load_client_state_dict(self, server_state_dict):
         # If you want to customize how to state dict is loaded you can do so here
         self.model.load_state_dict(server_state_dict)
@@ -36,21 +132,15 @@ class Base_Client():
         # recieved info : a server model weights(OrderedDict)
         # one globally merged model's parameter
         client_results = []
-        for client_idx in self.client_map[self.round]: # round is the index of communication round
+        for position, client_idx in enumerate(self.client_map[self.round]): # round is the index of communication round
             self.load_client_state_dict(received_info) 
-            self.train_dataloader = self.train_data[client_idx] # among dataloader, pick one
-            self.test_dataloader = self.test_data[client_idx]
-            if self.args.client_sample < 1.0 and self.train_dataloader._iterator is not None and self.train_dataloader._iterator._shutdown:
-                self.train_dataloader._iterator = self.train_dataloader._get_iterator()
-            self.client_index = client_idx
-            num_samples = len(self.train_dataloader)*self.args.batch_size
+            self.select_client(position, client_idx) # among dataloader, pick one
+            num_samples = num_train_samples(self.train_data[client_idx], self.args.batch_size)
             weights = self.train()
             acc = self.test(client_idx)
             client_results.append({'weights':weights, 'num_samples':num_samples,'acc':acc, 'client_index':self.client_index})
-            if self.args.client_sample < 1.0 and self.train_dataloader._iterator is not None:
-                self.train_dataloader._iterator._shutdown_workers()
 
-        self.round += 1
+        self.end_round()
         return client_results # clients' number of weights 
         
     def train(self):
@@ -117,6 +207,7 @@ class Base_Client():
             
             acc = (test_correct / test_sample_number)*100
             if self.args.dataset == 'NIH' or self.args.dataset == 'CheXpert':
+                from sklearn.metrics import roc_auc_score # only the X-ray tasks need sklearn, which is slow to import
                 try:
                     auc = roc_auc_score(gt, probs)
                 except:
@@ -175,22 +266,21 @@ class Base_Server():
         return [self.model.cpu().state_dict() for x in range(self.args.thread_number)]
 
     def log_info(self, client_info, acc):
+        log_round('server', self.round)
         client_acc = sum([c['acc'] for c in client_info])/len(client_info)
         out_str = 'Test/AccTop1: {}, Client_Train/AccTop1: {}, round: {}\n'.format(acc, client_acc, self.round)
         with open('{}/out.log'.format(self.save_path), 'a+') as out_file:
             out_file.write(out_str)
 
     def operations(self, client_info):
-        client_info.sort(key=lambda tup: tup['client_index']) 
+        client_info = trained_clients(client_info)
+        if not client_info: # nothing to aggregate; every thread keeps the current model
+            return [self.model.cpu().state_dict() for x in range(self.args.thread_number)]
         client_sd = [c['weights'] for c in client_info] # clients' number of weights
         ################################################################################################
         if self.harmony == 'y':
             gamma = self.gamma
-            cw1 = self.imbalance_weights
-            cw2 = [c['num_samples']/sum([x['num_samples'] for x in client_info]) for c in client_info]
-            cw1 = np.array(cw1)
-            cw2 = np.array(cw2)
-            cw = gamma * cw1 + (1 - gamma) * cw2
+            cw = harmony_weights(self.imbalance_weights, client_info, gamma)
             print("Clients weight: ", cw)
         else:
             cw = [c['num_samples']/sum([x['num_samples'] for x in client_info]) for c in client_info]
@@ -237,6 +327,7 @@ class Base_Server():
                 
             acc = (test_correct / test_sample_number)*100
             if self.args.dataset == 'NIH' or self.args.dataset == 'CheXpert':
+                from sklearn.metrics import roc_auc_score
                 auc = roc_auc_score(gt, probs)
                 logging.info("***** Server AUC = {:.4f} ,Acc = {:.4f} *********************************************************************".format(auc, acc))
                 f = open(result_dir + "/overall_performance.txt", "a")
@@ -7,6 +7,7 @@ https://github.com/42Shawn/LONDON/tree/master
 '''
 
 import random
+from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 
@@ -17,7 +18,6 @@ import models.ComputePostBN as pbn
 from torch.multiprocessing import current_process
 import numpy as np
 import random
-from sklearn.metrics import roc_auc_score
 from datetime import datetime
 import os
 
@@ -35,6 +35,10 @@ class Client(Base_Client):
         self.width_range = client_dict['width_range']
         self.resolutions = client_dict['resolutions']
         self.num_sub = args.num_subnets-1
+        self.model.precompute_widths(self.width_range)
+        self.bn_layers = pbn.bn_modules(self.model)
+        # client -> recalibration batches, least recently used first
+        self.calib_batches = OrderedDict()
 
     def train(self):
         # train the local model
@@ -48,7 +52,7 @@ class Client(Base_Client):
                 images, labels = images.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True)
                 self.optimizer.zero_grad()
                
-                self.model.apply(lambda m: setattr(m, 'width_mult', self.width_range[-1]))
+                self.model.set_width(self.width_range[-1])
                 t_feats, t_out = self.model.extract_feature(images)
 
                 if 'NIH' in self.dir or 'CheXpert' in self.dir:
@@ -58,7 +62,7 @@ class Client(Base_Client):
 
                 loss.backward()
                 loss_CE = loss.item()
-                self.model.apply(lambda m: setattr(m, 'width_mult', self.width_range[0]))
+                self.model.set_width(self.width_range[0])
                 s_feats = self.model.reuse_feature(t_feats[-2].detach())
                 
                 # Lipschitz loss
@@ -109,8 +113,18 @@ class Client(Base_Client):
         k=0
         with torch.no_grad():
             ###
-            self.model.apply(lambda m: setattr(m, 'width_mult', self.width_range[-1]))
-            self.model = pbn.ComputeBN(self.model, self.train_dataloader, self.resolutions[0], self.device)
+            self.model.set_width(self.width_range[-1])
+            if self.round % self.args.bn_recalib_every == 0:
+                postloader = self.train_dataloader
+                if self.args.bn_cache_batches > 0:
+                    if client_idx not in self.calib_batches:
+                        self.calib_batches[client_idx] = pbn.take_batches(self.train_dataloader, self.args.bn_recalib_batches+1)
+                    self.calib_batches.move_to_end(client_idx)
+                    postloader = self.calib_batches[client_idx]
+                    while len(self.calib_batches) > self.args.bn_cache_batches:
+                        self.calib_batches.popitem(last=False)
+                self.model = pbn.ComputeBN(self.model, postloader, self.resolutions[0], self.device,
+                                           num_batch=self.args.bn_recalib_batches, bn_layers=self.bn_layers)
             ###
             for batch_idx, (x, target) in enumerate(self.test_dataloader):
                 target = target.type(torch.LongTensor)
@@ -135,6 +149,7 @@ class Client(Base_Client):
             acc = (test_correct / test_sample_number)*100
 
             if self.args.dataset == 'NIH' or self.args.dataset == 'CheXpert':
+                from sklearn.metrics import roc_auc_score # only the X-ray tasks need sklearn, which is slow to import
                 try:
                     auc = roc_auc_score(gt, probs)
                 except:
@@ -181,7 +196,7 @@ class Server(Base_Server):
         k=0
         with torch.no_grad():
             ###
-            self.model.apply(lambda m: setattr(m, 'width_mult', 1.0))
+            self.model.set_width(1.0)
             ###
             for batch_idx, (x, target) in enumerate(self.test_data):
                 target = target.type(torch.LongTensor)
@@ -205,6 +220,7 @@ class Server(Base_Server):
 
             acc = (test_correct / test_sample_number)*100
             if self.args.dataset == 'NIH' or self.args.dataset == 'CheXpert':
+                from sklearn.metrics import roc_auc_score
                 auc = roc_auc_score(gt, probs)
                 logging.info("***** Server AUC = {:.4f} ,Acc = {:.4f} *********************************************************************".format(auc, acc))
                 f = open(result_dir + "/overall_performance.txt", "a")
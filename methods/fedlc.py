@@ -1,11 +1,10 @@
 import torch
-from methods.base import Base_Client, Base_Server
+from methods.base import Base_Client, Base_Server, num_train_samples, trained_clients
 import math
 import numpy as np
 import torch.nn as nn
 import logging
 from torch.multiprocessing import current_process
-import matplotlib.pyplot as plt
 import os
 from datetime import datetime
 
@@ -15,27 +14,15 @@ class FedLC_Loss():
 
         self.tau = tau
         self.device = device
-        self.label_distrib = torch.Tensor(pos_freq).to(self.device)
-        for i in range(len(self.label_distrib)):
-            for j in range(len(self.label_distrib[i])):
-                self.label_distrib[i][j] = max(1e-8, self.label_distrib[i][j])
-        print(self.label_distrib)
+        self.label_distrib = torch.Tensor(pos_freq).to(self.device).clamp(min=1e-8)
+        # per-client calibration offset tau * label_distrib^(-1/4)
+        self.offsets = self.tau * torch.pow(self.label_distrib, -1 / 4)
         self.epsilon = 1e-10
 
     def __call__(self, client_idx, logit, y):
 
         logit = logit.to(self.device)
-        loss = 0
-    
-        cal_logit = torch.exp(
-            logit
-            - (
-                self.tau
-                * torch.pow(self.label_distrib[client_idx], -1 / 4)
-                .unsqueeze(0)
-                .expand((logit.shape[0], -1))
-            )
-        )
+        cal_logit = torch.exp(logit - self.offsets[client_idx].unsqueeze(0))
         
         y_logit = torch.gather(cal_logit, dim=-1, index=y.unsqueeze(1))
         loss = -torch.log(y_logit / cal_logit.sum(dim=-1, keepdim=True) + self.epsilon)
@@ -59,21 +46,15 @@ class Client(Base_Client):
         # recieved info : a server model weights(OrderedDict)
         # one globally merged model's parameter
         client_results = []
-        for client_idx in self.client_map[self.round]: # round is the index of communication round
+        for position, client_idx in enumerate(self.client_map[self.round]): # round is the index of communication round
             self.load_client_state_dict(received_info) 
-            self.train_dataloader = self.train_data[client_idx] # among dataloader, pick one
-            self.test_dataloader = self.test_data[client_idx]
-            if self.args.client_sample < 1.0 and self.train_dataloader._iterator is not None and self.train_dataloader._iterator._shutdown:
-                self.train_dataloader._iterator = self.train_dataloader._get_iterator()
-            self.client_index = client_idx
-            num_samples = len(self.train_dataloader)*self.args.batch_size
+            self.select_client(position, client_idx) # among dataloader, pick one
+            num_samples = num_train_samples(self.train_data[client_idx], self.args.batch_size)
             weights = self.train(client_idx)
             acc = self.test(client_idx)
             client_results.append({'weights':weights, 'num_samples':num_samples,'acc':acc, 'client_index':self.client_index})
-            if self.args.client_sample < 1.0 and self.train_dataloader._iterator is not None:
-                self.train_dataloader._iterator._shutdown_workers()
 
-        self.round += 1
+        self.end_round()
         return client_results # clients' number of weights 
 
     def train(self, client_idx):
@@ -112,7 +93,9 @@ class Server(Base_Server):
         self.gamma = args.gamma
 
     def operations(self, client_info):
-        client_info.sort(key=lambda tup: tup['client_index'])
+        client_info = trained_clients(client_info)
+        if not client_info: # nothing to aggregate; every thread keeps the current model
+            return [self.model.cpu().state_dict() for x in range(self.args.thread_number)]
         client_sd = [c['weights'] for c in client_info] # clients' number of weights
         ################################################################################################
         cw = [c['num_samples']/sum([x['num_samples'] for x in client_info]) for c in client_info]
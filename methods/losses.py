@@ -0,0 +1,109 @@
+'''
+Class-balanced losses shared by the federated methods.
+Positive/negative weights follow the inverse effective number of samples of
+Cui et al., "Class-Balanced Loss Based on Effective Number of Samples", 2019.
+'''
+
+import hashlib
+import os
+import numpy as np
+import torch
+from data_preprocessing import config
+
+def inverse_effective_number(freq, beta, alpha=1, clamp_zero_freq=True): # beta is same for all classes
+    sons = np.array(freq, dtype=np.float64) / alpha # scaling factor
+    if clamp_zero_freq:
+        sons[sons == 0] = 1
+    with np.errstate(divide='ignore'):
+        En = (1 - beta) / (1 - np.power(beta, sons))
+    En[np.isnan(En)] = En.max()
+    return En
+
+def pnb_weights(pos_freq, neg_freq, beta=0.9999, clamp_zero_freq=True):
+    """
+    Normalized positive and negative weight tables, both (client_num, num_classes).
+    """
+    pos_weights = inverse_effective_number(pos_freq, beta, clamp_zero_freq=clamp_zero_freq)
+    neg_weights = inverse_effective_number(neg_freq, beta, clamp_zero_freq=clamp_zero_freq)
+    total = pos_weights + neg_weights
+    with np.errstate(invalid='ignore'):
+        pos_weights = np.nan_to_num(pos_weights / total)
+        neg_weights = neg_weights / total
+    return pos_weights, neg_weights
+
+# tables stored by build_weight_tables; part of the cache key, so adding one
+# invalidates files written without it
+WEIGHT_TABLES = ('pnb_pos', 'pnb_neg', 'pnb_pos_unclamped', 'pnb_neg_unclamped')
+
+def build_weight_tables(pos_freq, neg_freq, beta=0.9999, cache_dir=config.pkl_dir_path):
+    """
+    Compute the PNB weight tables of a partition once and store them in the
+    pickle cache, keyed by the client frequencies. Returns the path of the
+    .npz file, which every worker loads instead of recomputing the tables.
+    """
+    pos_freq = np.asarray(pos_freq, dtype=np.float64)
+    neg_freq = np.asarray(neg_freq, dtype=np.float64)
+    key = hashlib.sha1()
+    key.update(repr((pos_freq.shape, beta, WEIGHT_TABLES)).encode())
+    key.update(pos_freq.tobytes())
+    key.update(neg_freq.tobytes())
+    path = os.path.join(cache_dir, 'loss_tables_{}.npz'.format(key.hexdigest()[:16]))
+    if not os.path.exists(path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        pnb_pos, pnb_neg = pnb_weights(pos_freq, neg_freq, beta)
+        pnb_pos_unclamped, pnb_neg_unclamped = pnb_weights(pos_freq, neg_freq, beta, clamp_zero_freq=False)
+        tmp_path = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_path, pos_freq=pos_freq, neg_freq=neg_freq, pnb_pos=pnb_pos, pnb_neg=pnb_neg,
+                 pnb_pos_unclamped=pnb_pos_unclamped, pnb_neg_unclamped=pnb_neg_unclamped)
+        os.replace(tmp_path, path)
+    return path
+
+class PNB_loss():
+
+    def __init__(self, dataset, pos_freq, neg_freq, device, mu=1.0, clamp_zero_freq=True, tables=None):
+        self.beta = 0.9999
+        self.alpha = 1
+        self.mu = mu
+        self.dataset = dataset
+        # moon historically left zero frequencies unclamped (infinite weight,
+        # which the normalization turns into a zero positive weight)
+        self.clamp_zero_freq = clamp_zero_freq
+        if tables is not None:
+            # precomputed by build_weight_tables when the data was partitioned
+            suffix = '' if clamp_zero_freq else '_unclamped'
+            with np.load(tables) as t:
+                self.pos_weights = t['pnb_pos' + suffix]
+                self.neg_weights = t['pnb_neg' + suffix]
+        else:
+            self.pos_weights, self.neg_weights = pnb_weights(pos_freq, neg_freq, self.beta, clamp_zero_freq)
+
+        # (client_num, num_classes) tables, moved to the device once
+        self.pos_table = torch.as_tensor(self.pos_weights, dtype=torch.float32).to(device)
+        self.neg_table = torch.as_tensor(self.neg_weights, dtype=torch.float32).to(device)
+
+    def __call__(self, client_idx, y_pred, y_true, epsilon=1e-7):
+        """
+        Return weighted loss value. 
+
+        Args:
+            y_true (Tensor): Tensor of true labels, size is (num_examples, num_classes)
+                for NIH/CheXpert and (num_examples,) class indices otherwise
+            y_pred (Tensor): Tensor of predicted labels, size is (num_examples, num_classes);
+                logits for NIH/CheXpert and probabilities otherwise
+        Returns:
+            loss (Float): overall scalar loss summed across all classes
+        """
+        pos_w = self.pos_table[client_idx]
+        if self.dataset == 'NIH' or self.dataset == 'CheXpert':
+            neg_w = self.neg_table[client_idx]
+            prob = torch.sigmoid(y_pred)
+            # average weighted loss of every class, then weighted sum over classes
+            loss_pos = -1 * torch.mean(pos_w * y_true * torch.log(prob + epsilon), dim=0)
+            loss_neg = -1 * torch.mean(neg_w * (1 - y_true) * torch.log(1 - prob + epsilon), dim=0)
+            loss = torch.sum(self.mu * pos_w * (loss_pos + loss_neg))
+        else:
+            y_true = y_true.long()
+            loss_pos = -1 * torch.log(y_pred.gather(1, y_true.unsqueeze(1)).squeeze(1) + epsilon)
+            loss = torch.sum(self.mu * pos_w[y_true] * loss_pos) / len(y_true)
+        return loss
@@ -43,16 +43,38 @@ def adjust_momentum(module, t):
     if isinstance(module, nn.BatchNorm2d):
         module.momentum = 1 / (t+1)
 
-def ComputeBN(net, postloader, resolution, device, num_batch=8):
+def bn_modules(net):
+    # BN layers of the network, collected once so recalibration does not
+    # have to walk the whole module tree for every batch
+    return [m for m in net.modules() if isinstance(m, nn.BatchNorm2d)]
+
+def take_batches(loader, num_batch):
+    # Keep the first num_batch batches of a loader on the CPU so that later
+    # recalibrations of the same client can skip loading and decoding
+    batches = []
+    for batch_idx, batch in enumerate(loader):
+        batches.append(batch)
+        if not batch_idx < num_batch - 1:
+            break
+    return batches
+
+def ComputeBN(net, postloader, resolution, device, num_batch=8, bn_layers=None):
+    if bn_layers is None:
+        bn_layers = bn_modules(net)
     net.train()
-    net.apply(adjust_bn_layers)
+    for m in bn_layers:
+        adjust_bn_layers(m)
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(postloader):
             img = inputs.to(device)
-            net.apply(lambda m: adjust_momentum(m, batch_idx))
-            _ = net(F.interpolate(img, (resolution, resolution), mode='bilinear', align_corners=True))
+            for m in bn_layers:
+                adjust_momentum(m, batch_idx)
+            if img.shape[-2:] != (resolution, resolution):
+                img = F.interpolate(img, (resolution, resolution), mode='bilinear', align_corners=True)
+            _ = net(img)
             if not batch_idx < num_batch:
                 break
-    net.apply(restore_original_settings_of_bn_layers)
+    for m in bn_layers:
+        restore_original_settings_of_bn_layers(m)
     net.eval()
-    return net
\ No newline at end of file
+    return net
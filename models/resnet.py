@@ -104,7 +104,7 @@ class Bottleneck(nn.Module):
 class ResNet(nn.Module):
 
     def __init__(self, block, layers, num_classes=10, zero_init_residual=False, groups=1,
-                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False,  projection=False):
+                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False,  projection=False, in_channels=3):
         super(ResNet, self).__init__()
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
@@ -122,7 +122,7 @@ class ResNet(nn.Module):
 
         self.groups = groups
         self.base_width = width_per_group
-        self.conv1 = nn.Conv2d(3, self.inplanes, kernel_size=3, stride=1, padding=1,
+        self.conv1 = nn.Conv2d(in_channels, self.inplanes, kernel_size=3, stride=1, padding=1,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(self.inplanes)
         self.relu = nn.ReLU(inplace=True)
@@ -202,7 +202,7 @@ class ResNet(nn.Module):
 class ImageNet(nn.Module):
 
     def __init__(self, block, layers, num_classes=1000, zero_init_residual=False, groups=1,
-                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False,  projection=False):
+                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False,  projection=False, in_channels=3):
         super(ImageNet, self).__init__()
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
@@ -222,7 +222,7 @@ class ImageNet(nn.Module):
         self.base_width = width_per_group
         # self.conv1 = nn.Conv2d(3, self.inplanes, kernel_size=3, stride=1, padding=1,
         #                        bias=False)
-        self.conv1 = nn.Conv2d(3, self.inplanes, kernel_size=7, stride=2, padding=3,
+        self.conv1 = nn.Conv2d(in_channels, self.inplanes, kernel_size=7, stride=2, padding=3,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(self.inplanes)
         self.relu = nn.ReLU(inplace=True)
@@ -304,6 +304,18 @@ class ImageNet(nn.Module):
         else:
             return x
 
+def fold_input_channels(state_dict, in_channels, key='conv1.weight'):
+    """
+    Adapt the 3-channel stem of a checkpoint to a single-channel model.
+    A grayscale image replicated to RGB gives the same output as the single
+    channel convolved with the sum of the RGB filters, so the filters are
+    folded instead of dropped.
+    """
+    weight = state_dict.get(key)
+    if weight is not None and weight.shape[1] == 3 and in_channels == 1:
+        state_dict[key] = weight.sum(dim=1, keepdim=True)
+    return state_dict
+
 def resnet56(class_num, pretrained=False, path=None, **kwargs):
     """
     Constructs a ResNet-56 model.
@@ -323,7 +335,7 @@ def resnet56(class_num, pretrained=False, path=None, **kwargs):
             name = k.replace("module.", "")
             new_state_dict[name] = v
 
-        model.load_state_dict(new_state_dict)
+        model.load_state_dict(fold_input_channels(new_state_dict, model.conv1.in_channels))
     return model
 
 def resnet18(class_num, pretrained=False, path=None, **kwargs):
@@ -345,5 +357,5 @@ def resnet18(class_num, pretrained=False, path=None, **kwargs):
             name = k.replace("module.", "")
             new_state_dict[name] = v
 
-        model.load_state_dict(new_state_dict)
+        model.load_state_dict(fold_input_channels(new_state_dict, model.conv1.in_channels))
     return model
\ No newline at end of file
@@ -7,7 +7,8 @@ https://github.com/taoyang1122/GradAug
 
 import torch
 import torch.nn as nn
-from models.slimmable_ops import USBatchNorm2d, USConv2d, USLinear, make_divisible
+from models.slimmable_ops import USBatchNorm2d, USConv2d, USLinear, USNet, make_divisible
+from models.resnet import fold_input_channels
 
 def conv3x3(in_planes, out_planes, stride=1, groups=1, dilation=1, width_max=1.0):
     """3x3 convolution with padding"""
@@ -103,10 +104,10 @@ class Bottleneck(nn.Module):
         return out
 
 
-class ResNet(nn.Module):
+class ResNet(USNet, nn.Module):
 
     def __init__(self, block, layers, num_classes=10, zero_init_residual=False, groups=1,
-                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False, max_width=1.0):
+                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False, max_width=1.0, in_channels=3):
         super(ResNet, self).__init__()
         if norm_layer is None:
             norm_layer = USBatchNorm2d
@@ -114,7 +115,7 @@ class ResNet(nn.Module):
         self.max_width = max_width
         self.inplanes = 16
         self.dilation = 1
-        self.channel = 3
+        self.channel = in_channels
         if replace_stride_with_dilation is None:
             # each element in the tuple indicates if we should replace
             # the 2x2 stride with a dilated convolution instead
@@ -151,6 +152,7 @@ class ResNet(nn.Module):
                     nn.init.constant_(m.bn3.weight, 0)
                 elif isinstance(m, BasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
+        self.init_width_switch(self.max_width)
 
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
         norm_layer = self._norm_layer
@@ -213,10 +215,10 @@ class ResNet(nn.Module):
         x3 = self.layer3(x2)
         return [x2, x3]
 
-class ImageNet(nn.Module):
+class ImageNet(USNet, nn.Module):
 
     def __init__(self, block, layers, num_classes=1000, zero_init_residual=False, groups=1,
-                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False, max_width=1.0):
+                 width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD=False, max_width=1.0, in_channels=3):
         super(ImageNet, self).__init__()
         if norm_layer is None:
             norm_layer = USBatchNorm2d
@@ -234,7 +236,7 @@ class ImageNet(nn.Module):
 
         self.groups = groups
         self.base_width = width_per_group
-        self.conv1 = USConv2d(3, self.inplanes, kernel_size=7, stride=2, padding=3,
+        self.conv1 = USConv2d(in_channels, self.inplanes, kernel_size=7, stride=2, padding=3,
                                bias=False, us=[False, True], width_max=self.max_width)
         # self.conv1 = USConv2d(3, self.inplanes, kernel_size=3, stride=1, padding=1,
                             #    bias=False, us=[False, True], width_max=self.max_width)
@@ -263,6 +265,7 @@ class ImageNet(nn.Module):
                     nn.init.constant_(m.bn3.weight, 0)
                 elif isinstance(m, BasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
+        self.init_width_switch(self.max_width)
 
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
         norm_layer = self._norm_layer
@@ -350,7 +353,7 @@ def resnet56(class_num, pretrained=False, path=None, **kwargs):
             name = k.replace("module.", "")
             new_state_dict[name] = v
 
-        model.load_state_dict(new_state_dict)
+        model.load_state_dict(fold_input_channels(new_state_dict, model.conv1.in_channels))
     return model
 
 def resnet18(class_num, pretrained=False, path=None, **kwargs):
@@ -372,5 +375,5 @@ def resnet18(class_num, pretrained=False, path=None, **kwargs):
             name = k.replace("module.", "")
             new_state_dict[name] = v
 
-        model.load_state_dict(new_state_dict)
+        model.load_state_dict(fold_input_channels(new_state_dict, model.conv1.in_channels))
     return model
\ No newline at end of file
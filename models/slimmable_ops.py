@@ -4,6 +4,7 @@ https://github.com/taoyang1122/GradAug,
 https://github.com/taoyang1122/MutualNet
 '''
 
+import torch
 import torch.nn as nn
 # from utils.config import FLAGS
 # width_mult = FLAGS.width_mult_range[-1]
@@ -24,7 +25,104 @@ def make_divisible(v, divisor=8, min_value=1):
     return new_v
 
 
-class USConv2d(nn.Conv2d):
+class WidthState(object):
+    """
+    Width multiplier shared by all slimmable layers of a network, so that
+    switching the width of the whole network is a single assignment.
+    """
+    def __init__(self, width_mult=None):
+        self.width_mult = width_mult
+
+
+class USModule(object):
+    """
+    Mixin for slimmable layers. The active width is read from a (possibly
+    shared) WidthState and the channel counts of every width seen so far are
+    kept in width_plans, so make_divisible only runs once per width.
+    """
+    @property
+    def width_mult(self):
+        return self.width_state.width_mult
+
+    @width_mult.setter
+    def width_mult(self, value):
+        self.width_state.width_mult = value
+
+    def plan(self, width_mult=None):
+        if width_mult is None:
+            width_mult = self.width_state.width_mult
+        plan = self.width_plans.get(width_mult)
+        if plan is None:
+            plan = self.make_plan(width_mult)
+            self.width_plans[width_mult] = plan
+        return plan
+
+    def make_plan(self, width_mult):
+        raise NotImplementedError
+
+    def sliced_weight(self, out_channels, in_channels):
+        """
+        Leading [out_channels, in_channels] block of the weight as a contiguous
+        tensor. With autograd on, the copy is part of the graph so gradients
+        flow back into the full weight. Without autograd (evaluation, BN
+        recalibration) the copy is cached per width and only rebuilt when the
+        weight is modified in place, e.g. by an optimizer step or
+        load_state_dict.
+
+        Training is not cached: a FedAlign step runs every width once before
+        optimizer.step() changes the weight, so a packed per-width copy would
+        be rebuilt on every step anyway (benchmarks/subnet_step.py measures
+        no difference between the strided, contiguous and packed variants).
+        """
+        weight = self.weight
+        if out_channels == weight.size(0) and in_channels == weight.size(1):
+            return weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight[:out_channels, :in_channels].contiguous()
+        key = (out_channels, in_channels)
+        cached = self.weight_cache.get(key)
+        if cached is None or cached[0] != weight._version:
+            cached = (weight._version, weight.detach()[:out_channels, :in_channels].contiguous())
+            self.weight_cache[key] = cached
+        return cached[1]
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to()/.cuda()/.cpu() may replace parameter storage without bumping
+        # its version counter, so drop every cached slice.
+        self.weight_cache = {}
+        return super(USModule, self)._apply(fn, *args, **kwargs)
+
+
+class USNet(object):
+    """
+    Mixin for networks built from slimmable layers. All slimmable layers are
+    bound to one WidthState, so set_width switches the whole network at once
+    instead of walking the module tree with apply().
+    """
+    def init_width_switch(self, width_mult=1.0):
+        self.width_state = WidthState(width_mult)
+        self.us_layers = [m for m in self.modules() if isinstance(m, USModule)]
+        for m in self.us_layers:
+            m.width_state = self.width_state
+
+    @property
+    def width_mult(self):
+        return self.width_state.width_mult
+
+    @width_mult.setter
+    def width_mult(self, value):
+        self.width_state.width_mult = value
+
+    def set_width(self, width_mult):
+        self.width_state.width_mult = width_mult
+
+    def precompute_widths(self, widths):
+        for m in self.us_layers:
+            for width_mult in widths:
+                m.plan(width_mult)
+
+
+class USConv2d(USModule, nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
                  padding=0, dilation=1, groups=1, depthwise=False, bias=True,
                  us=[True, True], ratio=[1, 1], width_max=1.0):
@@ -48,25 +146,31 @@ class USConv2d(nn.Conv2d):
         self.depthwise = depthwise
         self.in_channels_basic = in_channels
         self.out_channels_basic = out_channels
-        self.width_mult = None
+        self.width_state = WidthState()
+        self.width_plans = {}
+        self.weight_cache = {}
         self.us = us
         self.ratio = ratio
 
-    def forward(self, input):
+    def make_plan(self, width_mult):
         in_channels = self.in_channels_basic
         out_channels = self.out_channels_basic
         if self.us[0]:
             in_channels = int(make_divisible(
                 self.in_channels_basic
-                * self.width_mult
+                * width_mult
                 / self.ratio[0]) * self.ratio[0])
         if self.us[1]:
             out_channels = int(make_divisible(
                 self.out_channels_basic
-                * self.width_mult
+                * width_mult
                 / self.ratio[1]) * self.ratio[1])
+        return in_channels, out_channels
+
+    def forward(self, input):
+        in_channels, out_channels = self.plan()
         self.groups = in_channels if self.depthwise else 1
-        weight = self.weight[:out_channels, :in_channels, :, :]
+        weight = self.sliced_weight(out_channels, in_channels)
         if self.bias is not None:
             bias = self.bias[:out_channels]
         else:
@@ -77,7 +181,7 @@ class USConv2d(nn.Conv2d):
         return y
 
 
-class USLinear(nn.Linear):
+class USLinear(USModule, nn.Linear):
     def __init__(self, in_features, out_features, bias=True, us=[True, True], width_max=1.0):
         in_features_max = in_features
         out_features_max = out_features
@@ -91,19 +195,25 @@ class USLinear(nn.Linear):
             in_features_max, out_features_max, bias=bias)
         self.in_features_basic = in_features
         self.out_features_basic = out_features
-        self.width_mult = None
+        self.width_state = WidthState()
+        self.width_plans = {}
+        self.weight_cache = {}
         self.us = us
 
-    def forward(self, input):
+    def make_plan(self, width_mult):
         in_features = self.in_features_basic
         out_features = self.out_features_basic
         if self.us[0]:
             in_features = make_divisible(
-                self.in_features_basic * self.width_mult)
+                self.in_features_basic * width_mult)
         if self.us[1]:
             out_features = make_divisible(
-                self.out_features_basic * self.width_mult)
-        weight = self.weight[:out_features, :in_features]
+                self.out_features_basic * width_mult)
+        return in_features, out_features
+
+    def forward(self, input):
+        in_features, out_features = self.plan()
+        weight = self.sliced_weight(out_features, in_features)
         if self.bias is not None:
             bias = self.bias[:out_features]
         else:
@@ -111,7 +221,7 @@ class USLinear(nn.Linear):
         return nn.functional.linear(input, weight, bias)
 
 
-class USBatchNorm2d(nn.BatchNorm2d):
+class USBatchNorm2d(USModule, nn.BatchNorm2d):
     def __init__(self, num_features, ratio=1, width_max=1.0):
         num_features_max = int(make_divisible(
             num_features * width_max / ratio) * ratio)
@@ -122,15 +232,20 @@ class USBatchNorm2d(nn.BatchNorm2d):
         self.bn = nn.BatchNorm2d(num_features_max, affine=False)
         self.width_max = width_max
         self.ratio = ratio
-        self.width_mult = None
+        self.width_state = WidthState()
+        self.width_plans = {}
         self.ignore_model_profiling = True
 
+    def make_plan(self, width_mult):
+        c = int(make_divisible(
+            self.num_features_basic * width_mult / self.ratio) * self.ratio)
+        return c, width_mult == self.width_max
+
     def forward(self, input):
         weight = self.weight
         bias = self.bias
-        c = int(make_divisible(
-            self.num_features_basic * self.width_mult / self.ratio) * self.ratio)
-        if self.width_mult==self.width_max:
+        c, full_width = self.plan()
+        if full_width:
             y = nn.functional.batch_norm(
                 input,
                 self.bn.running_mean[:c],